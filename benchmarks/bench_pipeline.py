@@ -0,0 +1,308 @@
+"""
+邮件合并流程的性能基准测试：读取 → 格式化 → 替换 → 保存
+
+生成合成的 Excel 工作簿（不同行数、混合数字格式）和合成的 Word 模板
+（不同占位符数量、run 碎片化程度、表格、页眉页脚、嵌入图片），
+分阶段计时并报告每秒行数、峰值内存，可与保存的基线对比。
+
+用法：
+    python benchmarks/bench_pipeline.py --rows 1000 10000
+    python benchmarks/bench_pipeline.py --rows 100000 --templates plain images
+    python benchmarks/bench_pipeline.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_pipeline.py --baseline benchmarks/baseline.json
+    python benchmarks/bench_pipeline.py --templates images --compression-level 1 --store-media
+
+基线与机器有关，不随仓库提交：在改动前用 --save-baseline 生成，改动后用相同参数 --baseline 对比。
+"""
+import os
+import sys
+import io
+import glob
+import json
+import time
+import zlib
+import struct
+import random
+import argparse
+import datetime
+import tempfile
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 工作簿各列的数字格式（覆盖 format_cell_value 处理的各类格式）
+COLUMN_FORMATS = [
+    ("编号", "000"),
+    ("账户名称", "@"),
+    ("账户余额", "¥#,##0.00"),
+    ("发生额", "#,##0"),
+    ("利率", "0.00%"),
+    ("起始日期", "yyyy-mm-dd"),
+    ("数量", "General"),
+    ("备注", "@"),
+]
+
+TEMPLATE_KINDS = ["plain", "fragmented", "many", "tables", "header_footer", "images"]
+
+
+# 加载主程序模块（文件名包含中文和括号，不能直接 import）
+def load_mail_merge():
+    path = glob.glob(os.path.join(REPO_DIR, "邮件合并小工具*.py"))[0]
+    spec = importlib.util.spec_from_file_location("mail_merge", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# 生成合成工作簿
+def make_workbook(path, rows, seed=0):
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+
+    rng = random.Random(seed)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append([name for name, _ in COLUMN_FORMATS])
+    start = datetime.date(2024, 1, 1)
+    for i in range(rows):
+        values = [
+            i + 1,
+            f"企业{rng.randint(1, 500)}",
+            rng.uniform(0, 1e8),
+            rng.randint(0, 10 ** 6),
+            rng.random() / 10,
+            start + datetime.timedelta(days=rng.randint(0, 365)),
+            rng.choice([rng.randint(0, 100), rng.uniform(0, 100)]),
+            rng.choice(["无", "冻结", "担保"]),
+        ]
+        row = []
+        for value, (_, number_format) in zip(values, COLUMN_FORMATS):
+            cell = WriteOnlyCell(ws, value=value)
+            cell.number_format = number_format
+            row.append(cell)
+        ws.append(row)
+    wb.save(path)
+
+
+# 生成不可压缩的PNG图片，模拟公章、签名等图片
+def make_png(width, height, seed=0):
+    rng = random.Random(seed)
+    raw = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 1))
+            + chunk(b"IEND", b""))
+
+
+# 把文本按 pieces 段拆成多个 run，模拟 Word 编辑后的碎片化
+def add_fragmented_text(paragraph, text, pieces):
+    step = max(1, len(text) // pieces)
+    for start in range(0, len(text), step):
+        paragraph.add_run(text[start:start + step])
+
+
+# 生成合成模板
+def make_template(path, kind):
+    from docx import Document
+    from docx.shared import Inches
+
+    doc = Document()
+    fields = [name for name, _ in COLUMN_FORMATS]
+    pieces = 4 if kind == "fragmented" else 1
+    repeat = 12 if kind == "many" else 1
+
+    for _ in range(repeat):
+        for field in fields:
+            paragraph = doc.add_paragraph()
+            add_fragmented_text(paragraph, f"{field}：«{field}»，请核对。", pieces)
+
+    if kind == "tables":
+        table = doc.add_table(rows=len(fields), cols=2)
+        for row, field in zip(table.rows, fields):
+            row.cells[0].text = field
+            row.cells[1].paragraphs[0].add_run(f"«{field}»")
+        nested = table.cell(0, 1).add_table(rows=1, cols=1)
+        nested.cell(0, 0).paragraphs[0].add_run("«编号»")
+
+    if kind == "header_footer":
+        section = doc.sections[0]
+        section.header.paragraphs[0].add_run("询证函编号：«编号»")
+        section.footer.paragraphs[0].add_run("«账户名称» 第1页")
+
+    if kind == "images":
+        for seed in range(2):
+            doc.add_picture(io.BytesIO(make_png(600, 600, seed)), width=Inches(2))
+
+    doc.save(path)
+
+
+# 把当前进程的峰值内存重置为当前占用（Linux），其他系统不支持时忽略
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+# 当前进程的峰值内存（MB）
+def peak_rss_mb():
+    # Linux 的 ru_maxrss 在 fork/exec 后沿用父进程的峰值，优先读取可重置的 VmHWM
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# 在独立进程中运行一个用例，保证峰值内存互不影响
+def run_case(excel_path, template_path, render_rows, use_xml_engine, compression_level=None, store_media=False):
+    # 只统计本用例自身的峰值，不含父进程生成合成文件时的内存
+    reset_peak_rss()
+    mm = load_mail_merge()
+    timings = {}
+
+    started = time.perf_counter()
+    columns, formatted_data = mm.read_excel_with_format(excel_path)
+    timings["read_format"] = time.perf_counter() - started
+    rows = len(formatted_data)
+
+    started = time.perf_counter()
+    template = mm.CompiledTemplate(template_path)
+    engine = template.xml_engine(compression_level, store_media) if use_xml_engine else None
+    timings["load_template"] = time.perf_counter() - started
+
+    # 替换和保存只取前 render_rows 行，避免大工作簿的用例运行过久
+    sample = formatted_data[:render_rows]
+    replace_seconds = save_seconds = 0.0
+    bytes_written = 0
+    for row_data in sample:
+        buffer = io.BytesIO()
+        started = time.perf_counter()
+        if engine is not None:
+            engine.render_to(buffer, row_data)
+            replace_seconds += time.perf_counter() - started
+        else:
+            doc = template.new_document()
+            mm.replace_placeholders(doc, row_data)
+            replace_seconds += time.perf_counter() - started
+            started = time.perf_counter()
+            mm.save_document(doc, buffer, compression_level, store_media)
+            save_seconds += time.perf_counter() - started
+        bytes_written += buffer.tell()
+    timings["replace"] = replace_seconds
+    timings["save"] = save_seconds
+
+    per_row = (replace_seconds + save_seconds) / len(sample) if sample else 0.0
+    return {
+        "rows": rows,
+        "rendered_rows": len(sample),
+        "read_rows_per_sec": rows / timings["read_format"] if timings["read_format"] else None,
+        "render_rows_per_sec": 1 / per_row if per_row else None,
+        "bytes_per_doc": bytes_written // len(sample) if sample else 0,
+        "peak_rss_mb": peak_rss_mb(),
+        "timings": {stage: round(seconds, 4) for stage, seconds in timings.items()},
+    }
+
+
+# 与基线对比，返回回退的指标列表
+def compare(results, baseline, threshold):
+    regressions = []
+    for case, result in results.items():
+        base = baseline.get(case)
+        if not base:
+            continue
+        for metric in ("read_rows_per_sec", "render_rows_per_sec"):
+            if result.get(metric) and base.get(metric) and result[metric] < base[metric] * (1 - threshold):
+                regressions.append(f"{case} {metric}: {result[metric]:.1f} < 基线 {base[metric]:.1f}")
+        if result.get("peak_rss_mb") and base.get("peak_rss_mb") and \
+                result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + threshold):
+            regressions.append(f"{case} peak_rss_mb: {result['peak_rss_mb']} > 基线 {base['peak_rss_mb']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="邮件合并流程性能基准测试")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000], help="工作簿行数，可指定多个")
+    parser.add_argument("--templates", nargs="+", default=TEMPLATE_KINDS, choices=TEMPLATE_KINDS, help="模板类型")
+    parser.add_argument("--render-rows", type=int, default=200, help="每个用例实际替换并保存的行数")
+    parser.add_argument("--xml-engine", action="store_true", help="同时测试XML快速引擎")
+    parser.add_argument("--compression-level", type=int, choices=range(10), metavar="0-9",
+                        help="输出文档的压缩级别，默认与 Word 相同")
+    parser.add_argument("--store-media", action="store_true", help="图片等已压缩的媒体直接存储")
+    parser.add_argument("--workdir", help="存放合成文件的目录（可复用，避免重复生成）")
+    parser.add_argument("--output", help="把结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与基线 JSON 对比，有回退时退出码为 1")
+    parser.add_argument("--save-baseline", help="把本次结果保存为基线")
+    parser.add_argument("--threshold", type=float, default=0.1, help="允许的回退比例，默认 10%%")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mailmerge_bench_")
+    os.makedirs(workdir, exist_ok=True)
+
+    engines = [False, True] if args.xml_engine else [False]
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for rows in args.rows:
+        excel_path = os.path.join(workdir, f"rows_{rows}.xlsx")
+        if not os.path.exists(excel_path):
+            # 合成文件也在独立进程中生成，主进程的峰值内存保持很低，不会被用例进程继承
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                executor.submit(make_workbook, excel_path, rows).result()
+        for kind in args.templates:
+            template_path = os.path.join(workdir, f"template_{kind}.docx")
+            if not os.path.exists(template_path):
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    executor.submit(make_template, template_path, kind).result()
+            for use_xml_engine in engines:
+                case = f"{rows}/{kind}/{'xml' if use_xml_engine else 'docx'}"
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(run_case, excel_path, template_path,
+                                             args.render_rows, use_xml_engine,
+                                             args.compression_level, args.store_media).result()
+                results[case] = result
+                print(f"{case:32s} 读取 {result['read_rows_per_sec'] or 0:10.1f} 行/秒  "
+                      f"生成 {result['render_rows_per_sec'] or 0:8.1f} 份/秒  "
+                      f"每份 {result['bytes_per_doc'] / 1024:.0f} KB  "
+                      f"峰值内存 {result['peak_rss_mb']} MB  {result['timings']}", flush=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"⚠️ 性能回退：{line}")
+        if regressions:
+            return 1
+        print("✅ 与基线相比没有明显回退")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,34 @@
+"""
+测试公共设施：加载主程序模块（文件名包含中文和括号，不能直接 import）
+"""
+import glob
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_mail_merge():
+    if "mail_merge" in sys.modules:
+        return sys.modules["mail_merge"]
+    path = glob.glob(os.path.join(REPO_DIR, "邮件合并小工具*.py"))[0]
+    spec = importlib.util.spec_from_file_location("mail_merge", path)
+    module = importlib.util.module_from_spec(spec)
+    # 注册到 sys.modules，并行生成时工作进程才能按模块名找到函数
+    sys.modules["mail_merge"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def mm():
+    return load_mail_merge()
+
+
+@pytest.fixture(autouse=True)
+def template_cache_dir(mm, tmp_path, monkeypatch):
+    # 模板分析缓存写到临时目录，不污染用户目录
+    monkeypatch.setattr(mm.template_cache, "cache_dir", str(tmp_path / "template_cache"))
@@ -0,0 +1,65 @@
+"""
+合并为一个 Word 文档：各份文档的编号和书签合并后仍然唯一
+"""
+import collections
+import os
+import zipfile
+
+from docx import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
+from lxml import etree
+
+W14 = "http://schemas.microsoft.com/office/word/2010/wordml"
+
+
+def make_template(path):
+    doc = Document()
+    doc.add_paragraph("致：«单位名称»")
+    body = doc.element.body
+    # 带书签、书签超链接、REF 域和段落标识的段落，模拟 Word 保存的模板
+    body.insert(len(body) - 1, parse_xml(
+        f'<w:p {nsdecls("w")} xmlns:w14="{W14}" w14:paraId="1A2B3C4D" w14:textId="77777777">'
+        '<w:bookmarkStart w:id="0" w:name="OLE_LINK1"/><w:r><w:t>金额</w:t></w:r>'
+        '<w:bookmarkEnd w:id="0"/>'
+        '<w:hyperlink w:anchor="OLE_LINK1"><w:r><w:t>见上</w:t></w:r></w:hyperlink>'
+        '<w:r><w:instrText xml:space="preserve"> REF OLE_LINK1 \\h </w:instrText></w:r></w:p>'))
+    doc.save(path)
+
+
+def test_combined_document_ids_are_unique(mm, tmp_path):
+    template = str(tmp_path / "template.docx")
+    make_template(template)
+    data = [{"单位名称": f"单位{i}"} for i in range(3)]
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    stats = {}
+    mm.generate_documents(template, data, [f"函{i}" for i in range(3)], str(output_dir),
+                          output_mode="combined", stats=stats)
+    
+    with zipfile.ZipFile(stats["output_path"]) as zf:
+        root = etree.fromstring(zf.read("word/document.xml"))
+    starts = list(root.iter(qn("w:bookmarkStart")))
+    ends = list(root.iter(qn("w:bookmarkEnd")))
+    names = [start.get(qn("w:name")) for start in starts]
+    assert len(starts) == 3
+    assert len(set(names)) == 3
+    assert len({start.get(qn("w:id")) for start in starts}) == 3
+    # 每个书签的首尾编号仍然成对
+    assert collections.Counter(start.get(qn("w:id")) for start in starts) == \
+        collections.Counter(end.get(qn("w:id")) for end in ends)
+    # 超链接和域代码跟随书签改名
+    assert sorted(link.get(qn("w:anchor")) for link in root.iter(qn("w:hyperlink"))) == sorted(names)
+    assert sorted(instr.text.split()[1] for instr in root.iter(qn("w:instrText"))) == sorted(names)
+    assert not [element for element in root.iter() if f"{{{W14}}}paraId" in element.attrib]
+    
+    texts = [p.text for p in Document(stats["output_path"]).paragraphs]
+    assert [text for text in texts if text.startswith("致：")] == ["致：单位0", "致：单位1", "致：单位2"]
+
+
+def test_combined_sink_without_documents_leaves_no_output(mm, tmp_path):
+    path = str(tmp_path / "合并.docx")
+    sink = mm.CombinedDocumentSink(path)
+    sink.close()
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ".part")
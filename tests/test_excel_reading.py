@@ -0,0 +1,34 @@
+"""
+Excel 读取：过时的 <dimension> 不能导致漏读
+"""
+import re
+import zipfile
+
+import openpyxl
+
+
+def make_stale_dimension_workbook(path):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(["a", "b"])
+    for i in range(5):
+        ws.append([f"x{i}", i])
+    wb.save(path)
+    # 把工作表的 <dimension> 改成只有 A1，模拟其他程序写出的过时记录
+    with zipfile.ZipFile(path) as zf:
+        entries = {info.filename: zf.read(info) for info in zf.infolist()}
+    sheet = "xl/worksheets/sheet1.xml"
+    entries[sheet] = re.sub(rb'<dimension ref="[^"]*"/>', b'<dimension ref="A1"/>', entries[sheet])
+    assert b'<dimension ref="A1"/>' in entries[sheet]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries.items():
+            zf.writestr(name, data)
+
+
+def test_stale_dimension_reads_all_rows_and_columns(mm, tmp_path):
+    path = str(tmp_path / "stale.xlsx")
+    make_stale_dimension_workbook(path)
+    columns, formatted_data = mm.read_excel_with_format(path)
+    assert columns == ["a", "b"]
+    assert len(formatted_data) == 5
+    assert dict(formatted_data[4]) == {"a": "x4", "b": "4"}
@@ -0,0 +1,73 @@
+"""
+增量生成：跳过内容未变化的行，中断后从清单继续
+"""
+import os
+import threading
+
+import pytest
+from docx import Document
+
+
+@pytest.fixture
+def job(tmp_path):
+    template = tmp_path / "template.docx"
+    doc = Document()
+    doc.add_paragraph("致：«单位名称»")
+    doc.save(template)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    data = [{"单位名称": f"单位{i}"} for i in range(5)]
+    names = [f"函{i}" for i in range(5)]
+    return str(template), data, names, str(output_dir)
+
+
+def run(mm, job, data=None, **kwargs):
+    template, default_data, names, output_dir = job
+    stats = {}
+    successes, failures = mm.generate_documents(template, data or default_data, names, output_dir,
+                                                incremental=True, stats=stats, **kwargs)
+    assert failures == []
+    return successes, stats.get("skipped", 0)
+
+
+def text(job, name):
+    return Document(os.path.join(job[3], name + ".docx")).paragraphs[0].text
+
+
+def test_unchanged_rows_are_skipped(mm, job):
+    assert run(mm, job) == (5, 0)
+    assert run(mm, job) == (0, 5)
+
+
+def test_changed_or_missing_rows_are_regenerated(mm, job):
+    run(mm, job)
+    data = [dict(row) for row in job[1]]
+    data[1]["单位名称"] = "改名单位"
+    os.remove(os.path.join(job[3], "函3.docx"))
+    assert run(mm, job, data) == (2, 3)
+    assert text(job, "函1") == "致：改名单位"
+    assert text(job, "函3") == "致：单位3"
+
+
+def test_template_change_regenerates_everything(mm, job):
+    run(mm, job)
+    doc = Document(job[0])
+    doc.add_paragraph("此致")
+    doc.save(job[0])
+    assert run(mm, job) == (5, 0)
+
+
+def test_resume_after_interruption(mm, job):
+    cancel_event = threading.Event()
+    
+    def progress(done, total):
+        if done >= 2:
+            cancel_event.set()
+    
+    assert run(mm, job, cancel_event=cancel_event, progress_callback=progress) == (2, 0)
+    # 模拟崩溃时清单末尾写了一半的记录
+    with open(os.path.join(job[3], ".mailmerge_manifest.jsonl"), "a", encoding="utf-8") as f:
+        f.write('{"file": "函2.docx", "ro')
+    assert run(mm, job) == (3, 2)
+    assert sorted(name for name in os.listdir(job[3]) if name.endswith(".docx")) == [f"函{i}.docx" for i in range(5)]
+    assert run(mm, job) == (0, 5)
@@ -0,0 +1,48 @@
+"""
+占位符替换：无论占位符在 Word 中被拆成几个 run，替换结果都相同
+"""
+import itertools
+
+import pytest
+from docx import Document
+
+TEXT = "致«单位名称»：金额«金额»元«未知»。"
+ROW = {"单位名称": "甲公司", "金额": "1,000.00"}
+EXPECTED = "致甲公司：金额1,000.00元«未知»。"
+
+
+def split_paragraph(cuts):
+    doc = Document()
+    p = doc.add_paragraph()
+    bounds = [0, *cuts, len(TEXT)]
+    for idx, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        # 奇数 run 加粗，模拟 Word 按格式拆分 run
+        p.add_run(TEXT[start:end]).bold = bool(idx % 2)
+    return doc, p
+
+
+@pytest.mark.parametrize("cuts", list(itertools.combinations(range(1, len(TEXT)), 2))[::7] +
+                         [tuple(range(1, len(TEXT)))])
+def test_replacement_is_independent_of_run_splits(mm, cuts):
+    doc, p = split_paragraph(cuts)
+    runs_before = len(p.runs)
+    assert mm.replace_placeholders(doc, ROW) == 2
+    assert p.text == EXPECTED
+    # 不增删 run，只改写文本
+    assert len(p.runs) == runs_before
+
+
+def test_value_takes_format_of_first_run(mm):
+    # "«单位" 在普通 run，"名称»" 在加粗 run
+    doc, p = split_paragraph((TEXT.index("名称"), TEXT.index("：")))
+    mm.replace_placeholders(doc, ROW)
+    assert [(run.text, run.bold) for run in p.runs] == [("致甲公司", False), ("", True), ("：金额1,000.00元«未知»。", False)]
+
+
+def test_paragraph_run_index_locate(mm):
+    doc, p = split_paragraph((2, 5, 5, 9))
+    index = mm.ParagraphRunIndex(p)
+    start = TEXT.index("«单位")
+    end = TEXT.index("：")
+    # 第 3 个 run 为空，不会被选为结束的 run
+    assert index.locate(start, end) == (0, 1, 3, 2)
@@ -0,0 +1,97 @@
+"""
+模板修剪：删除部件和样式后，生成的文档中没有悬空的样式或关系引用
+"""
+import posixpath
+import zipfile
+
+import pytest
+from docx import Document
+from lxml import etree
+
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+NS = {"w": W}
+STYLE_REFERENCES = ("//w:pStyle/@w:val | //w:rStyle/@w:val | //w:tblStyle/@w:val | //w:numStyleLink/@w:val"
+                    " | //w:styleLink/@w:val | //w:basedOn/@w:val | //w:link/@w:val | //w:next/@w:val")
+FOOTNOTES = (f'<w:footnotes xmlns:w="{W}"><w:footnote w:id="1"><w:p><w:pPr><w:pStyle w:val="Quote"/></w:pPr>'
+             '<w:r><w:t>脚注</w:t></w:r></w:p></w:footnote></w:footnotes>')
+
+
+def make_template(path):
+    doc = Document()
+    doc.add_paragraph("«单位名称»", style="Heading 1")
+    doc.add_table(rows=1, cols=1, style="Light Grid Accent 1").cell(0, 0).text = "«金额»"
+    doc.save(path)
+    # 加一个只有 Quote 样式引用的脚注部件（python-docx 不解析脚注）
+    with zipfile.ZipFile(path) as zf:
+        entries = {info.filename: zf.read(info) for info in zf.infolist()}
+    entries["word/footnotes.xml"] = FOOTNOTES.encode("utf-8")
+    entries["word/_rels/document.xml.rels"] = entries["word/_rels/document.xml.rels"].replace(
+        b"</Relationships>",
+        b'<Relationship Id="rIdFn" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+        b'footnotes" Target="footnotes.xml"/></Relationships>')
+    entries["[Content_Types].xml"] = entries["[Content_Types].xml"].replace(
+        b"</Types>",
+        b'<Override PartName="/word/footnotes.xml" ContentType="application/vnd.openxmlformats-officedocument.'
+        b'wordprocessingml.footnotes+xml"/></Types>')
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in entries.items():
+            zf.writestr(name, data)
+
+
+def dangling_references(path):
+    problems = []
+    with zipfile.ZipFile(path) as zf:
+        names = set(zf.namelist())
+        # 关系目标必须存在
+        for rels_name in (name for name in names if name.endswith(".rels")):
+            source_dir = posixpath.dirname(posixpath.dirname(rels_name))
+            for rel in etree.fromstring(zf.read(rels_name)):
+                if rel.get("TargetMode") == "External":
+                    continue
+                target = posixpath.normpath(posixpath.join(source_dir, rel.get("Target"))).lstrip("/")
+                if target not in names:
+                    problems.append(f"{rels_name} -> {target}")
+        content_types = etree.fromstring(zf.read("[Content_Types].xml"))
+        for override in content_types.iter("{*}Override"):
+            if override.get("PartName").lstrip("/") not in names:
+                problems.append(f"[Content_Types].xml -> {override.get('PartName')}")
+        # 正文、脚注、编号和样式本身引用的样式必须在 styles.xml 中定义
+        style_ids = set(etree.fromstring(zf.read("word/styles.xml")).xpath("//w:style/@w:styleId", namespaces=NS))
+        for name in sorted(names):
+            if name.endswith(".xml") and name.startswith("word/") and name != "word/stylesWithEffects.xml":
+                for style_id in etree.fromstring(zf.read(name)).xpath(STYLE_REFERENCES, namespaces=NS):
+                    if style_id not in style_ids:
+                        problems.append(f"{name} -> 样式 {style_id}")
+    return problems
+
+
+@pytest.mark.parametrize("use_xml_engine", [False, True])
+def test_pruned_documents_have_no_dangling_references(mm, tmp_path, use_xml_engine):
+    template = str(tmp_path / "template.docx")
+    make_template(template)
+    assert dangling_references(template) == []
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    stats = {}
+    mm.generate_documents(template, [{"单位名称": "甲公司", "金额": "1.00"}], ["甲"], str(output_dir),
+                          use_xml_engine=use_xml_engine, prune_parts=True, stats=stats)
+    
+    output = str(output_dir / "甲.docx")
+    assert dangling_references(output) == []
+    with zipfile.ZipFile(output) as zf:
+        names = set(zf.namelist())
+        style_ids = set(etree.fromstring(zf.read("word/styles.xml")).xpath("//w:style/@w:styleId", namespaces=NS))
+    assert "docProps/thumbnail.jpeg" not in names
+    assert "word/footnotes.xml" in names
+    # 被引用的样式及其依赖保留，其余删除
+    assert {"Heading1", "Heading1Char", "Normal", "LightGrid-Accent1", "Quote"} <= style_ids
+    assert "MediumGrid3-Accent6" not in style_ids
+    assert Document(output).paragraphs[0].text == "甲公司"
+
+
+def test_prune_reports_removed_content(mm, tmp_path):
+    template = str(tmp_path / "template.docx")
+    make_template(template)
+    pruned = mm.CompiledTemplate(template).prune()
+    assert pruned["parts"] == ["/docProps/thumbnail.jpeg"]
+    assert pruned["styles"] > 100
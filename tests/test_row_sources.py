@@ -0,0 +1,27 @@
+"""
+数据源：SQLite 只读查询
+"""
+import sqlite3
+
+import pytest
+
+
+@pytest.mark.parametrize("name", ["data.db", "100%数据 #1?.db", "a%20b.db"])
+def test_sqlite_source_reads_special_paths(mm, tmp_path, name):
+    path = tmp_path / name
+    connection = sqlite3.connect(path)
+    connection.execute("create table t (单位 text, 金额 real)")
+    connection.executemany("insert into t values (?, ?)", [("甲", 1.5), ("乙", 2)])
+    connection.commit()
+    connection.close()
+    
+    columns, rows = mm.SqliteSource(str(path), "select * from t").open()
+    assert columns == ["单位", "金额"]
+    assert [row["单位"] for row in rows] == ["甲", "乙"]
+
+
+def test_sqlite_source_is_read_only(mm, tmp_path):
+    path = tmp_path / "data.db"
+    sqlite3.connect(path).close()
+    with pytest.raises(sqlite3.OperationalError):
+        mm.SqliteSource(str(path), "create table t (a text)").open()
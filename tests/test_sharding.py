@@ -0,0 +1,62 @@
+"""
+分片生成：各分片合起来覆盖全部行，汇总时发现缺失的分片和文件
+"""
+import os
+
+import pytest
+from docx import Document
+
+SHARDS = 3
+
+
+@pytest.fixture
+def job(tmp_path):
+    template = tmp_path / "template.docx"
+    doc = Document()
+    doc.add_paragraph("致：«单位名称»")
+    doc.save(template)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    data = [{"单位名称": f"单位{i}"} for i in range(20)]
+    names = [f"函{i}" for i in range(20)]
+    return str(template), data, names, str(output_dir)
+
+
+def run_shard(mm, job, index):
+    template, data, names, output_dir = job
+    return mm.generate_documents(template, data, names, output_dir, shard=(index, SHARDS))
+
+
+def test_shards_cover_all_rows_once(mm, job):
+    successes = [run_shard(mm, job, index)[0] for index in range(1, SHARDS + 1)]
+    assert sum(successes) == 20
+    assert all(successes)
+    report = mm.merge_shard_reports(job[3])
+    assert report["complete"] is True
+    assert (report["total"], report["assigned"], report["successes"]) == (20, 20, 20)
+    assert report["duplicate_outputs"] == report["missing_outputs"] == report["missing_shards"] == []
+    assert sorted(name for name in os.listdir(job[3]) if name.endswith(".docx")) == \
+        sorted(f"函{i}.docx" for i in range(20))
+    # 合并后的主清单覆盖全部文件，之后不分片增量运行时全部跳过
+    stats = {}
+    assert mm.generate_documents(job[0], job[1], job[2], job[3], incremental=True, stats=stats)[0] == 0
+    assert stats["skipped"] == 20
+
+
+def test_missing_shard_is_reported(mm, job):
+    run_shard(mm, job, 1)
+    run_shard(mm, job, 3)
+    report = mm.merge_shard_reports(job[3])
+    assert report["complete"] is False
+    assert report["missing_shards"] == [2]
+    assert report["assigned"] < 20
+
+
+def test_missing_output_file_is_reported(mm, job):
+    for index in range(1, SHARDS + 1):
+        run_shard(mm, job, index)
+    os.remove(os.path.join(job[3], "函7.docx"))
+    report = mm.merge_shard_reports(job[3])
+    assert report["complete"] is False
+    # 报告中的行号从 1 开始
+    assert [(item["row"], item["file"]) for item in report["missing_outputs"]] == [(8, "函7.docx")]
@@ -0,0 +1,60 @@
+"""
+XML 快速引擎与 python-docx 逐段替换的结果一致
+"""
+import io
+
+import pytest
+from docx import Document
+
+
+def make_template(path):
+    doc = Document()
+    p = doc.add_paragraph("致：")
+    # 占位符跨越格式不同的多个run
+    p.add_run("«单位")
+    p.add_run("名称»").bold = True
+    p.add_run("，金额«金额»元")
+    p = doc.add_paragraph("经办人：")
+    p.add_run("«经")
+    p.add_run("办").italic = True
+    p.add_run("人»，日期«日期»")
+    doc.sections[0].header.paragraphs[0].text = "«单位名称»"
+    doc.save(path)
+
+
+def runs(doc):
+    paragraphs = doc.paragraphs + doc.sections[0].header.paragraphs
+    return [[(run.text, run.bold, run.italic) for run in p.runs] for p in paragraphs]
+
+
+def render_both(mm, path, row):
+    template = mm.CompiledTemplate.load(path)
+    doc = template.new_document()
+    docx_count = mm.replace_placeholders(doc, row)
+    docx_runs = runs(doc)
+    buffer = io.BytesIO()
+    xml_count = template.xml_engine().render_to(buffer, row)
+    return (docx_runs, docx_count), (runs(Document(buffer)), xml_count)
+
+
+@pytest.mark.parametrize("row", [
+    {"单位名称": "甲公司", "金额": "1,000.00", "经办人": "张三", "日期": "2024-01-31"},
+    # 缺少字段：跨run的占位符保持模板原样
+    {"单位名称": "甲公司", "金额": "1,000.00"},
+    {"日期": "2024-01-31"},
+    {},
+])
+def test_xml_engine_matches_python_docx(mm, tmp_path, row):
+    path = str(tmp_path / "template.docx")
+    make_template(path)
+    docx_result, xml_result = render_both(mm, path, row)
+    assert xml_result == docx_result
+
+
+def test_unmapped_split_placeholder_keeps_runs(mm, tmp_path):
+    path = str(tmp_path / "template.docx")
+    make_template(path)
+    _, (paragraphs, replaced) = render_both(mm, path, {"单位名称": "甲公司"})
+    assert replaced == 2
+    assert paragraphs[1] == [("经办人：", None, None), ("«经", None, None), ("办", None, True),
+                             ("人»，日期«日期»", None, None)]
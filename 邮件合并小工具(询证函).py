@@ -1,432 +1,2519 @@
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from tkinter import ttk
-import pandas as pd
-from docx import Document
 import os
 import re
+import pathlib
+import bisect
+import contextlib
+import csv
+import cProfile
+import heapq
+import pstats
+import tempfile
+import shutil
+import copy
+import io
+import struct
+import time
+import zipfile
+import zlib
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import datetime
-import numpy as np
-import openpyxl
+import functools
+import collections
+import collections.abc
+import hashlib
+import itertools
+import json
+import sqlite3
+import platform
+import argparse
+import sys
+import queue
+import threading
+
+# 界面相关模块在启动图形界面时才导入（命令行模式不需要显示器）
+tk = filedialog = messagebox = simpledialog = ttk = None
 
 # 设置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# 格式化Excel数据
-def format_cell_value(cell):
+# 货币符号
+CURRENCY_SYMBOLS = ['¥', '$', '€', '￥']
+
+# 从格式代码中提取小数位数
+def _decimal_places(format_code, default):
+    if '.' in format_code:
+        decimal_part = format_code.split('.')[-1]
+        if '0' in decimal_part:
+            return decimal_part.count('0')
+    return default
+
+# 格式化日期时间
+def _format_datetime(value):
+    if hasattr(value, 'hour') and (value.hour != 0 or value.minute != 0 or value.second != 0):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    return value.strftime('%Y-%m-%d')
+
+# 格式化普通数字
+def _format_general(value, is_integer):
+    if is_integer:
+        return str(int(value))
+    # 移除不必要的小数点和尾随零
+    return str(value).rstrip('0').rstrip('.') if '.' in str(value) else str(value)
+
+# 编译Excel格式代码
+@functools.lru_cache(maxsize=512)
+def compile_number_format(format_code):
+    """
+    将格式代码解析一次，返回 formatter(value) -> str；
+    同一列通常只有一种格式代码，编译结果按格式代码缓存（超出容量时淘汰最久未用的）
+    """
+    format_code = format_code or ""
+    
+    # 前导零格式 (如 "000")，只对整数值生效
+    zero_width = 0
+    if format_code.startswith('0') and not any(c != '0' for c in format_code):
+        zero_width = len(format_code)
+    
+    # 按格式族生成数字格式化函数
+    symbol = next((s for s in CURRENCY_SYMBOLS if s in format_code), None)
+    if symbol is not None:
+        # 货币格式：默认保留2位小数
+        decimal_places = _decimal_places(format_code, 2)
+        def format_number(value, is_integer):
+            if is_integer and decimal_places == 0:
+                return f"{symbol}{int(value):,}"
+            return f"{symbol}{value:,.{decimal_places}f}"
+    elif '#,##0' in format_code or '#,###' in format_code:
+        # 带千分位的数字
+        decimal_places = _decimal_places(format_code, 0)
+        def format_number(value, is_integer):
+            if is_integer and decimal_places == 0:
+                return f"{int(value):,}"
+            return f"{value:,.{decimal_places}f}"
+    elif '%' in format_code:
+        # 百分比
+        decimal_places = _decimal_places(format_code, 0)
+        def format_number(value, is_integer):
+            return f"{value*100:.{decimal_places}f}%"
+    else:
+        format_number = _format_general
+    
+    def formatter(value):
+        if value is None:
+            return ""
+        # 文本格式保持原样
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return _format_datetime(value)
+        if isinstance(value, (int, float)):
+            is_integer = isinstance(value, int) or value.is_integer()
+            if zero_width and is_integer:
+                return str(int(value)).zfill(zero_width)
+            return format_number(value, is_integer)
+        # 其他情况，转换为字符串
+        return str(value)
+    
+    return formatter
+
+# 格式化Excel数据
+def format_cell_value(cell):
+    """
+    根据Excel单元格格式对数据进行格式化
+    """
+    if cell.value is None:
+        return ""
+    return compile_number_format(cell.number_format)(cell.value)
+
+# 批量格式化一列数据
+def format_column_values(values, format_codes):
+    """
+    format_codes 可以是整列共用的一个格式代码，也可以是与 values 等长的格式代码列表；
+    连续相同的格式代码只查找一次格式化函数
+    """
+    if isinstance(format_codes, str):
+        formatter = compile_number_format(format_codes)
+        return [formatter(value) for value in values]
+    
+    results = []
+    last_code = None
+    formatter = None
+    for value, format_code in zip(values, format_codes):
+        if formatter is None or format_code != last_code:
+            formatter = compile_number_format(format_code)
+            last_code = format_code
+        results.append(formatter(value))
+    return results
+
+# 文本中的日期格式（CSV、数据库等非Excel数据源）
+TEXT_DATE_FORMATS = ['%Y-%m-%d', '%Y/%m/%d', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%Y%m%d']
+
+# 把文本解析为数字，无法解析时返回 None
+def _parse_number(text):
+    cleaned = text.replace(',', '')
+    for symbol in CURRENCY_SYMBOLS:
+        cleaned = cleaned.replace(symbol, '')
+    scale = 1
+    if cleaned.endswith('%'):
+        cleaned, scale = cleaned[:-1], 100
+    try:
+        return int(cleaned) if scale == 1 else int(cleaned) / scale
+    except ValueError:
+        pass
+    try:
+        return float(cleaned) / scale
+    except ValueError:
+        return None
+
+# 把文本解析为日期，无法解析时返回 None
+def _parse_date(text):
+    for date_format in TEXT_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    return None
+
+# 格式代码中不影响分类的部分：[颜色]、[DBNum1]、[$-804] 等方括号段，"文字"，转义字符，_ 占位和 * 填充
+FORMAT_LITERAL_PATTERN = re.compile(r'\[[^\]]*\]|"[^"]*"|\\.|_.|\*.')
+
+# 日期时间格式的标记（去掉文字部分后）：yy、dd、m/d、mmm、h:mm、:ss 等
+DATE_TOKEN_PATTERN = re.compile(r'yy|dd|m+d|[md][-/.]|[-/.][md]|mmm|h+:|:m|:s|am/pm')
+
+# 判断格式代码是否为日期时间格式
+def is_date_format(format_code):
+    code = FORMAT_LITERAL_PATTERN.sub('', (format_code or "").lower())
+    return DATE_TOKEN_PATTERN.search(code) is not None
+
+# 编译列格式规则
+@functools.lru_cache(maxsize=512)
+def compile_format_rule(format_code):
+    """
+    与 compile_number_format 相同，但先把文本值转换为格式代码需要的数字或日期，
+    使 CSV、数据库等数据源中的文本按 Excel 单元格格式的方式格式化；无法转换的文本保持原样
+    """
+    formatter = compile_number_format(format_code)
+    code = (format_code or "").lower()
+    if code in ("", "general", "@"):
+        return formatter
+    parse = _parse_date if is_date_format(format_code) else _parse_number
+    
+    def convert(value):
+        if isinstance(value, str):
+            parsed = parse(value.strip()) if value.strip() else None
+            if parsed is not None:
+                value = parsed
+        return formatter(value)
+    
+    return convert
+
+# 按列格式规则批量格式化一列数据
+def format_rule_values(values, format_code):
+    converter = compile_format_rule(format_code)
+    return [converter(value) for value in values]
+
+# 运行指标收集
+class MergeMetrics:
+    """
+    记录各阶段耗时和计数、每行延迟直方图、替换数量、写入字节数和最慢的行，
+    运行结束后导出为 JSON 或 CSV。profile_every 大于0时每隔若干行用 cProfile 采样一次
+    """
+    # 延迟直方图的分桶上限（毫秒）
+    latency_buckets_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self, slowest=10, profile_every=0, profile_path=None):
+        self.stages = {}
+        self.counters = {}
+        self.histogram = [0] * (len(self.latency_buckets_ms) + 1)
+        self.rows = []
+        self.slowest = slowest
+        self.profile_every = profile_every
+        self.profile_path = profile_path
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - started)
+
+    def add_stage(self, name, seconds, calls=1):
+        total = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        total['seconds'] += seconds
+        total['calls'] += calls
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_row(self, row, row_metrics):
+        """
+        row_metrics 包含各子阶段耗时（秒）以及 replaced、bytes
+        """
+        seconds = sum(value for key, value in row_metrics.items() if key not in ('replaced', 'bytes'))
+        for key, value in row_metrics.items():
+            if key in ('replaced', 'bytes'):
+                self.count(f"{key}_total", value)
+            else:
+                self.add_stage(f"row.{key}", value)
+        self.histogram[bisect.bisect_left(self.latency_buckets_ms, seconds * 1000)] += 1
+        self.rows.append((row, seconds, row_metrics.get('replaced', 0), row_metrics.get('bytes', 0)))
+
+    def summary(self):
+        latencies = sorted(seconds for _, seconds, _, _ in self.rows)
+        
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+        
+        labels = [f"<={bound}ms" for bound in self.latency_buckets_ms] + [f">{self.latency_buckets_ms[-1]}ms"]
+        return {
+            'stages': {name: {'seconds': round(total['seconds'], 4), 'calls': total['calls']}
+                       for name, total in self.stages.items()},
+            'counters': self.counters,
+            'rows': len(self.rows),
+            'latency_ms': {'p50': round(percentile(0.5) * 1000, 2), 'p90': round(percentile(0.9) * 1000, 2),
+                           'p99': round(percentile(0.99) * 1000, 2), 'max': round(percentile(1.0) * 1000, 2)},
+            'latency_histogram': dict(zip(labels, self.histogram)),
+            'slowest_rows': [
+                {'row': row + 1, 'ms': round(seconds * 1000, 2), 'replaced': replaced, 'bytes': size}
+                for row, seconds, replaced, size in heapq.nlargest(self.slowest, self.rows, key=lambda item: item[1])
+            ],
+        }
+
+    def export(self, path):
+        """
+        .csv 导出每行明细，其他扩展名导出 JSON 汇总
+        """
+        if path.lower().endswith('.csv'):
+            with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+                writer = csv.writer(f)
+                writer.writerow(['row', 'ms', 'replaced', 'bytes'])
+                for row, seconds, replaced, size in self.rows:
+                    writer.writerow([row + 1, round(seconds * 1000, 3), replaced, size])
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+# 生成列名（与 pandas 的处理方式一致：空表头为 Unnamed: n，重复表头加 .1、.2 后缀）
+def make_column_names(header_values):
+    while header_values and header_values[-1] is None:
+        header_values = header_values[:-1]
+    
+    column_names = []
+    seen = {}
+    for idx, value in enumerate(header_values):
+        name = f"Unnamed: {idx}" if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+            while name in seen:
+                name = f"{name}.1"
+        seen[name] = 0
+        column_names.append(name)
+    return column_names
+
+# 按块读取行，并按列批量格式化
+def _iter_row_blocks(rows, column_names, block_size=1000, format_rules=None):
+    """
+    每次取 block_size 行，按列收集值和格式代码后整列格式化，
+    产出 [(行数据字典, 是否为空行), ...]。format_rules 中指定的列不使用单元格格式，而使用规则中的格式代码
+    """
+    width = len(column_names)
+    block_values = []
+    block_codes = []
+    rules = [(format_rules or {}).get(name) for name in column_names]
+    
+    def flush():
+        columns = [
+            format_rule_values(values, rule) if rule else format_column_values(values, codes)
+            for values, codes, rule in zip(zip(*block_values), zip(*block_codes), rules)
+        ]
+        block = [
+            (dict(zip(column_names, row_values)), all(value is None for value in raw_values))
+            for row_values, raw_values in zip(zip(*columns), block_values)
+        ]
+        block_values.clear()
+        block_codes.clear()
+        return block
+    
+    for row in rows:
+        values = [cell.value for cell in row] + [None] * (width - len(row))
+        codes = [cell.number_format for cell in row] + ["General"] * (width - len(row))
+        block_values.append(values)
+        block_codes.append(codes)
+        if len(block_values) >= block_size:
+            yield flush()
+    if block_values:
+        yield flush()
+
+# 流式读取Excel数据
+def iter_excel_rows(excel_path, format_rules=None):
+    """
+    以只读模式单次遍历工作表，返回 (列名列表, 格式化行的生成器)。
+    生成器逐行产出 {列名: 格式化后的值}，遍历结束时关闭工作簿
+    """
+    import openpyxl
+    
+    wb = openpyxl.load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        # 只读模式默认相信工作表记录的 <dimension>，它过时（如 ref="A1"）时会漏读行和列，改为实际扫描
+        ws.reset_dimensions()
+        header = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+        column_names = make_column_names(list(header))
+    except Exception:
+        wb.close()
+        raise
+    
+    def generate():
+        try:
+            if not column_names:
+                return
+            # 中间的空行保留，末尾的空行丢弃
+            pending_empty = []
+            rows = ws.iter_rows(min_row=2, max_col=len(column_names))
+            for block in _iter_row_blocks(rows, column_names, format_rules=format_rules):
+                for row_data, is_empty in block:
+                    if is_empty:
+                        pending_empty.append(row_data)
+                        continue
+                    yield from pending_empty
+                    pending_empty.clear()
+                    yield row_data
+        finally:
+            wb.close()
+    
+    return column_names, generate()
+
+# 按列存储的格式化数据
+class FormattedRows(collections.abc.Sequence):
+    """
+    按列保存格式化后的字符串，相同的字符串只保存一份；按行访问时返回轻量的只读行视图，
+    行视图支持 in、[] 和 items()，可以直接传给 replace_placeholders
+    """
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self._column_index = {column: idx for idx, column in enumerate(self.columns)}
+        self._data = [[] for _ in self.columns]
+        self._strings = {}
+
+    def append(self, row_data):
+        strings = self._strings
+        for column, values in zip(self.columns, self._data):
+            value = row_data.get(column, "")
+            values.append(strings.setdefault(value, value))
+
+    # 加载完成后释放去重用的字典，只保留各列数据
+    def finish(self):
+        self._strings = {}
+        return self
+
+    def column(self, name):
+        return self._data[self._column_index[name]]
+
+    def __len__(self):
+        return len(self._data[0]) if self._data else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [RowView(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return RowView(self, index)
+
+# 一行数据的只读视图
+class RowView(collections.abc.Mapping):
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def __getitem__(self, column):
+        store = self._store
+        return store._data[store._column_index[column]][self._row]
+
+    def __contains__(self, column):
+        return column in self._store._column_index
+
+    def __iter__(self):
+        return iter(self._store.columns)
+
+    def __len__(self):
+        return len(self._store.columns)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        # 传给工作进程时只传这一行，而不是整个数据表
+        return dict, (dict(self),)
+
+# 数据源
+class RowSource:
+    """
+    open() 返回 (列名列表, 行生成器)，生成器逐行产出与 read_excel_with_format 相同的
+    {列名: 格式化后的值}。数据按块读取、逐列格式化，内存占用与总行数无关。
+    format_rules 为 {列名: Excel格式代码}，如 {"编号": "000", "余额": "¥#,##0.00", "日期": "yyyy-mm-dd"}
+    """
+    kind = 'source'
+    block_size = 1000
+
+    def __init__(self, path, format_rules=None):
+        self.path = path
+        self.format_rules = dict(format_rules or {})
+
+    def open(self):
+        raise NotImplementedError
+
+    def load(self, metrics=None):
+        """
+        读取全部行，返回 (列名列表, 按列存储的 FormattedRows)
+        """
+        metrics = metrics or MergeMetrics()
+        with metrics.stage(f'{self.kind}.open'):
+            column_names, rows = self.open()
+        with metrics.stage(f'{self.kind}.read_format'):
+            formatted_data = FormattedRows(column_names)
+            for row_data in rows:
+                formatted_data.append(row_data)
+            formatted_data.finish()
+        metrics.count(f'{self.kind}_rows', len(formatted_data))
+        metrics.count(f'{self.kind}_cells', len(formatted_data) * len(column_names))
+        return column_names, formatted_data
+
+    def _format_blocks(self, column_names, blocks):
+        """
+        blocks 产出原始值的行列表，按列格式化后逐行产出字典；没有规则的列按常规格式处理
+        """
+        rules = [self.format_rules.get(name, "General") for name in column_names]
+        width = len(column_names)
+        for block in blocks:
+            block = [list(row[:width]) + [None] * (width - len(row)) for row in block]
+            columns = [format_rule_values(values, rule) for values, rule in zip(zip(*block), rules)]
+            for row_values in zip(*columns):
+                yield dict(zip(column_names, row_values))
+
+# Excel 数据源
+class ExcelSource(RowSource):
+    kind = 'excel'
+
+    def open(self):
+        return iter_excel_rows(self.path, self.format_rules)
+
+# CSV 数据源
+class CsvSource(RowSource):
+    """
+    默认按 UTF-8（可带 BOM）读取，编码不对时改用 GBK；空行跳过
+    """
+    kind = 'csv'
+
+    def __init__(self, path, format_rules=None, encoding=None, delimiter=','):
+        super().__init__(path, format_rules)
+        self.encoding = encoding
+        self.delimiter = delimiter
+
+    def _detect_encoding(self):
+        with open(self.path, 'rb') as f:
+            sample = f.read(64 * 1024)
+        try:
+            sample.decode('utf-8-sig')
+        except UnicodeDecodeError as e:
+            # 采样可能在多字节字符中间截断
+            if e.start < len(sample) - 3:
+                return 'gbk'
+        return 'utf-8-sig'
+
+    def open(self):
+        f = open(self.path, newline='', encoding=self.encoding or self._detect_encoding())
+        try:
+            reader = csv.reader(f, delimiter=self.delimiter)
+            header = next(reader, [])
+            column_names = make_column_names([value or None for value in header])
+        except Exception:
+            f.close()
+            raise
+        
+        def blocks():
+            try:
+                while True:
+                    rows = list(itertools.islice(reader, self.block_size))
+                    if not rows:
+                        return
+                    block = [row for row in rows if any(row)]
+                    if block:
+                        yield block
+            finally:
+                f.close()
+        
+        return column_names, self._format_blocks(column_names, blocks())
+
+# SQLite 数据源
+class SqliteSource(RowSource):
+    """
+    以只读方式执行 query，按块取出结果
+    """
+    kind = 'sqlite'
+
+    def __init__(self, path, query, format_rules=None):
+        super().__init__(path, format_rules)
+        if not query:
+            raise ValueError("SQLite 数据源需要查询语句")
+        self.query = query
+
+    def open(self):
+        # 路径中的 %、?、#、空格和中文等都要按 URI 规则转义
+        uri = pathlib.Path(self.path).resolve().as_uri() + "?mode=ro"
+        connection = sqlite3.connect(uri, uri=True)
+        try:
+            cursor = connection.execute(self.query)
+            column_names = make_column_names([column[0] for column in cursor.description or ()])
+        except Exception:
+            connection.close()
+            raise
+        
+        def blocks():
+            try:
+                while True:
+                    block = cursor.fetchmany(self.block_size)
+                    if not block:
+                        return
+                    yield block
+            finally:
+                connection.close()
+        
+        return column_names, self._format_blocks(column_names, blocks())
+
+# 数据文件扩展名对应的数据源
+SOURCE_EXTENSIONS = {'.csv': CsvSource, '.txt': CsvSource, '.db': SqliteSource, '.sqlite': SqliteSource,
+                     '.sqlite3': SqliteSource}
+
+# 根据文件扩展名创建数据源
+def open_row_source(path, query=None, format_rules=None):
+    source_class = SOURCE_EXTENSIONS.get(os.path.splitext(path)[1].lower(), ExcelSource)
+    if source_class is SqliteSource:
+        return SqliteSource(path, query, format_rules)
+    return source_class(path, format_rules)
+
+# 读取格式规则文件（JSON：{列名: Excel格式代码}）
+def load_format_rules(path):
+    with open(path, encoding='utf-8') as f:
+        rules = json.load(f)
+    if not isinstance(rules, dict):
+        raise ValueError(f"格式规则应为 {{列名: 格式代码}}：{path}")
+    return {str(column): str(code) for column, code in rules.items()}
+
+# 读取Excel数据和格式信息
+def read_excel_with_format(excel_path, metrics=None, format_rules=None):
+    """
+    单次遍历读取Excel数据并按单元格格式格式化，返回 (列名列表, 按列存储的 FormattedRows)
+    """
+    return ExcelSource(excel_path, format_rules).load(metrics)
+
+# 占位符格式：«字段名»
+PLACEHOLDER_PATTERN = re.compile(r'«([^»]+)»')
+
+# 重复行占位符的前缀：表格中含 «@列名» 的行按组内每条记录重复一次
+REPEAT_PREFIX = '@'
+
+# 占位符对应的 Excel 列名（去掉重复行前缀）
+def placeholder_column(field):
+    return field[len(REPEAT_PREFIX):] if field.startswith(REPEAT_PREFIX) else field
+
+# 页眉页脚的所有类型
+HEADER_FOOTER_TYPES = ['header', 'first_page_header', 'even_page_header',
+                       'footer', 'first_page_footer', 'even_page_footer']
+
+# 遍历文档中的所有段落
+def iter_document_paragraphs(doc, placeholder_only=True):
+    """
+    按文档顺序遍历正文（含表格、嵌套表格、文本框）以及所有章节的各类页眉页脚，
+    每个XML段落只访问一次，产出 (部件, 部件内段落序号, 段落)。
+    placeholder_only 为 True 时跳过不含 '«' 的段落
+    """
+    from docx.oxml.ns import qn
+    from docx.text.paragraph import Paragraph
+    
+    containers = [(doc.part, doc.element.body, doc._body)]
+    seen_parts = {doc.part}
+    for section in doc.sections:
+        for hf_type in HEADER_FOOTER_TYPES:
+            header_footer = getattr(section, hf_type)
+            # 没有自己定义的页眉页脚与前一节共用，不能访问以免 python-docx 自动创建
+            if header_footer.is_linked_to_previous:
+                continue
+            part = header_footer.part
+            if part not in seen_parts:
+                seen_parts.add(part)
+                containers.append((part, part.element, header_footer))
+    
+    text_tag = qn('w:t')
+    for part, element, parent in containers:
+        for para_idx, p in enumerate(element.iter(qn('w:p'))):
+            # 只检查 w:t 文本节点，比拼接整个段落文本快得多
+            if placeholder_only and not any(t.text and '«' in t.text for t in p.iter(text_tag)):
+                continue
+            yield part, para_idx, Paragraph(p, parent)
+
+# 提取Word文档中的所有占位符
+def extract_placeholders(doc):
+    placeholders = set()
+    for _, _, para in iter_document_paragraphs(doc):
+        para_text = ''.join([run.text for run in para.runs])
+        placeholders.update(PLACEHOLDER_PATTERN.findall(para_text))
+    return placeholders
+
+# 段落的run偏移索引
+class ParagraphRunIndex:
+    """
+    缓存段落的run列表和每个run的结束偏移，用二分查找定位占位符跨越的runs；
+    替换后只标记受影响位置之后的偏移失效，需要时再增量重算
+    """
+    def __init__(self, paragraph):
+        self.runs = paragraph.runs
+        self.texts = [run.text for run in self.runs]
+        self.ends = list(itertools.accumulate(len(text) for text in self.texts))
+        # ends 中前 _valid 项是准确的
+        self._valid = len(self.ends)
+
+    @property
+    def text(self):
+        return ''.join(self.texts)
+
+    def _refresh(self):
+        total = self.ends[self._valid - 1] if self._valid else 0
+        for i in range(self._valid, len(self.texts)):
+            total += len(self.texts[i])
+            self.ends[i] = total
+        self._valid = len(self.ends)
+
+    def _search(self, search, pos):
+        idx = search(self.ends, pos, 0, self._valid)
+        if idx == self._valid and self._valid < len(self.ends):
+            self._refresh()
+            idx = search(self.ends, pos)
+        return idx
+
+    def locate(self, start_pos, end_pos):
+        """
+        返回占位符的 (开始run索引, 开始run内偏移, 结束run索引, 结束run内偏移)，找不到时返回 None
+        """
+        # 开始run：第一个结束偏移大于 start_pos 的run（空run不会被选中）
+        start_run_idx = self._search(bisect.bisect_right, start_pos)
+        # 结束run：第一个结束偏移不小于 end_pos 的run
+        end_run_idx = self._search(bisect.bisect_left, end_pos)
+        if start_run_idx >= len(self.ends) or end_run_idx >= len(self.ends):
+            return None
+        start_offset = self.ends[start_run_idx] - len(self.texts[start_run_idx])
+        end_offset = self.ends[end_run_idx] - len(self.texts[end_run_idx])
+        return start_run_idx, start_pos - start_offset, end_run_idx, end_pos - end_offset
+
+    def replace(self, start_pos, end_pos, value):
+        """
+        用 value 替换段落文本中 [start_pos, end_pos) 的内容并保留run格式，成功时返回 True
+        """
+        span = self.locate(start_pos, end_pos)
+        if span is None:
+            return False
+        start_run_idx, start_run_pos, end_run_idx, end_run_pos = span
+        
+        # 处理占位符在单个run中的情况
+        if start_run_idx == end_run_idx:
+            text = self.texts[start_run_idx]
+            self._set_text(start_run_idx, text[:start_run_pos] + value + text[end_run_pos:])
+        else:
+            # 处理占位符跨越多个runs的情况
+            # 处理第一个run（保留前部分并添加替换值）
+            self._set_text(start_run_idx, self.texts[start_run_idx][:start_run_pos] + value)
+            
+            # 处理最后一个run（只保留尾部）
+            self._set_text(end_run_idx, self.texts[end_run_idx][end_run_pos:])
+            
+            # 清空中间的runs
+            for i in range(start_run_idx + 1, end_run_idx):
+                self._set_text(i, "")
+        
+        self._valid = min(self._valid, start_run_idx)
+        return True
+
+    def _set_text(self, run_idx, text):
+        self.runs[run_idx].text = text
+        self.texts[run_idx] = text
+
+# 替换单个段落中的占位符
+def replace_in_paragraph(paragraph, replacements, location):
+    """
+    从后向前替换段落中的占位符，location 用于错误日志，返回替换数量
+    """
+    index = ParagraphRunIndex(paragraph)
+    
+    # 查找段落中的所有占位符，没有则跳过
+    matches = list(PLACEHOLDER_PATTERN.finditer(index.text))
+    if not matches:
+        return 0
+    
+    replaced_count = 0
+    # 从后向前替换，前面占位符的偏移不受影响
+    for match in reversed(matches):
+        key = match.group(1)
+        if key in replacements:
+            try:
+                if index.replace(match.start(), match.end(), replacements[key]):
+                    replaced_count += 1
+            except Exception as e:
+                logger.error(f"替换{location}中的'{match.group(0)}'时出错: {e}")
+    return replaced_count
+
+# 替换模板中的字段
+def replace_placeholders(doc, replacements):
+    replaced_count = 0
+    
+    try:
+        # 正文、表格、页眉页脚中的段落统一遍历，逐段替换（更好地保留格式）
+        for part, para_idx, para in iter_document_paragraphs(doc):
+            replaced_count += replace_in_paragraph(para, replacements, f"{part.partname}段落#{para_idx}")
+        
+        return replaced_count
+    except Exception as e:
+        logger.error(f"替换文档模板时发生错误: {e}")
+        return 0
+
+# 展开正文表格中的重复行
+def expand_repeating_rows(doc, records):
+    """
+    表格中含 «@列名» 占位符的行是重复行：每条记录复制一行并替换为该记录的值，
+    模板行本身删除。返回替换的占位符数量
+    """
+    from docx.oxml.ns import qn
+    from docx.text.paragraph import Paragraph
+    
+    text_tag = qn('w:t')
+    marker = '«' + REPEAT_PREFIX
+    template_rows = [
+        tr for tr in doc.element.body.iter(qn('w:tr'))
+        if marker in ''.join(t.text or '' for t in tr.iter(text_tag))
+    ]
+    
+    replaced_count = 0
+    expanded = set()
+    for row_idx, tr in enumerate(template_rows):
+        # 嵌套在重复行里的表格行随外层行一起复制
+        if any(ancestor in expanded for ancestor in tr.iterancestors(qn('w:tr'))):
+            continue
+        expanded.add(tr)
+        for record in records:
+            values = {REPEAT_PREFIX + str(key): value for key, value in record.items()}
+            row = copy.deepcopy(tr)
+            for para_idx, p in enumerate(row.iter(qn('w:p'))):
+                replaced_count += replace_in_paragraph(Paragraph(p, None), values, f"重复行#{row_idx}段落#{para_idx}")
+            tr.addprevious(row)
+        tr.getparent().remove(tr)
+    return replaced_count
+
+# 预览中页眉页脚类型的名称
+HEADER_FOOTER_LABELS = {'header': '页眉', 'first_page_header': '首页页眉', 'even_page_header': '偶数页页眉',
+                        'footer': '页脚', 'first_page_footer': '首页页脚', 'even_page_footer': '偶数页页脚'}
+
+# 预览一行数据替换后的文字（不保存文档）
+def render_preview(template, row_data):
+    """
+    基于已解析的 CompiledTemplate 生成一份文档并替换占位符（含重复行），不打包、不写文件。
+    按文档顺序返回 ([(位置, 文本)], 替换数量)：正文段落、表格的每一行（单元格以 " | " 分隔）、
+    各节的页眉页脚。没有对应数据的占位符保持 «字段» 原样
+    """
+    from docx.oxml.ns import qn
+    
+    doc = template.new_document()
+    replaced_count = 0
+    if template.has_repeating_rows:
+        replaced_count += expand_repeating_rows(doc, getattr(row_data, 'records', None) or [row_data])
+    replaced_count += replace_placeholders(doc, row_data)
+    
+    text_tags = {qn('w:t'): None, qn('w:tab'): '\t', qn('w:br'): '\n', qn('w:cr'): '\n'}
+    
+    def paragraph_text(p):
+        parts = []
+        for node in p.iter(*text_tags):
+            text = text_tags[node.tag]
+            parts.append(node.text or '' if text is None else text)
+        return ''.join(parts)
+    
+    def table_rows(tbl):
+        for tr in tbl.iterchildren(qn('w:tr')):
+            yield " | ".join('\n'.join(text for _, text in blocks(tc, None)) for tc in tr.iterchildren(qn('w:tc')))
+    
+    # 块级元素：段落、表格（逐行），内容控件展开其中的内容
+    def blocks(element, label):
+        for child in element.iterchildren():
+            if child.tag == qn('w:p'):
+                yield label, paragraph_text(child)
+            elif child.tag == qn('w:tbl'):
+                for text in table_rows(child):
+                    yield label, text
+            elif child.tag in (qn('w:sdt'), qn('w:sdtContent'), qn('w:customXml')):
+                yield from blocks(child, label)
+    
+    lines = []
+    table_count = 0
+    for child in doc.element.body.iterchildren():
+        if child.tag == qn('w:tbl'):
+            table_count += 1
+            lines.extend((f"表格{table_count} 第{n}行", text) for n, text in enumerate(table_rows(child), 1))
+        elif child.tag == qn('w:p'):
+            lines.append(("正文", paragraph_text(child)))
+        elif child.tag in (qn('w:sdt'), qn('w:customXml')):
+            lines.extend(blocks(child, "正文"))
+    
+    seen_parts = set()
+    for section_idx, section in enumerate(doc.sections, 1):
+        for hf_type in HEADER_FOOTER_TYPES:
+            header_footer = getattr(section, hf_type)
+            if header_footer.is_linked_to_previous or header_footer.part in seen_parts:
+                continue
+            seen_parts.add(header_footer.part)
+            label = f"第{section_idx}节 {HEADER_FOOTER_LABELS[hf_type]}"
+            lines.extend(blocks(header_footer.part.element, label))
+    # 空段落不显示
+    return [(label, text) for label, text in lines if text.strip()], replaced_count
+
+# 模板分析结果的磁盘缓存
+class TemplateAnalysisCache:
+    """
+    以模板的路径、大小、修改时间和内容哈希为键，把占位符集合和run范围映射保存在磁盘上，
+    模板未变化时无需解析即可得到分析结果。缓存总大小超过 max_bytes 时淘汰最久未用的条目
+    """
+    def __init__(self, cache_dir=None, max_bytes=16 * 1024 * 1024):
+        self.cache_dir = cache_dir or os.environ.get('MAILMERGE_CACHE_DIR') or \
+            os.path.join(os.path.expanduser("~"), ".mailmerge_cache", "templates")
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, word_path):
+        word_path = os.path.abspath(word_path)
+        stat = os.stat(word_path)
+        key = f"{word_path}|{stat.st_size}|{stat.st_mtime_ns}|{file_fingerprint(word_path)}"
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + ".json")
+
+    def load(self, word_path):
+        """
+        返回缓存的分析结果，未命中时返回 None
+        """
+        try:
+            entry_path = self._entry_path(word_path)
+            with open(entry_path, encoding='utf-8') as f:
+                analysis = json.load(f)
+            # 更新访问时间，用于淘汰
+            os.utime(entry_path)
+            return analysis
+        except (OSError, ValueError):
+            return None
+
+    def store(self, word_path, analysis):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entry_path = self._entry_path(word_path)
+            temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(analysis, f, ensure_ascii=False)
+            os.replace(temp_path, entry_path)
+            self._evict()
+        except OSError as e:
+            logger.warning(f"写入模板缓存失败: {e}")
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+    def placeholders(self, word_path):
+        """
+        返回模板中的占位符集合，缓存未命中时解析模板并写入缓存
+        """
+        analysis = self.load(word_path)
+        if analysis is None:
+            return CompiledTemplate.load(word_path, self).placeholders
+        return set(analysis['placeholders'])
+
+template_cache = TemplateAnalysisCache()
+
+# 编译后的Word模板：模板只解析一次，每行数据基于内存中的副本生成文档
+class CompiledTemplate:
+    """
+    一次性解析Word模板，记录每个占位符所在的位置（部件、段落、run范围），
+    之后每行数据都从已解析XML树的内存副本创建文档，不再重复读取和解析.docx文件
+    """
+    def __init__(self, word_path, analysis=None):
+        from docx import Document
+        
+        self.word_path = word_path
+        self._doc = Document(word_path)
+        # 按打包选项缓存的XML快速引擎
+        self._xml_engines = {}
+        self.pruned = None
+        
+        if analysis is not None:
+            # 使用缓存的分析结果，不再扫描段落
+            self.placeholders = set(analysis['placeholders'])
+            self.locations = [tuple(location) for location in analysis['locations']]
+            parts = set(self._doc.part.package.iter_parts())
+        else:
+            self.placeholders = set()
+            # 每个元素为 (部件名, 段落序号, 开始run索引, 结束run索引, 占位符键)
+            self.locations = []
+            
+            # 扫描占位符
+            parts = {self._doc.part}
+            for part, para_idx, para in iter_document_paragraphs(self._doc):
+                parts.add(part)
+                index = ParagraphRunIndex(para)
+                for match in PLACEHOLDER_PATTERN.finditer(index.text):
+                    self.placeholders.add(match.group(1))
+                    span = index.locate(match.start(), match.end())
+                    if span is not None:
+                        self.locations.append((str(part.partname), para_idx, span[0], span[2], match.group(1)))
+        
+        # 只保存含占位符部件（以及正文部件）的原始XML，其余部件在各文档间共享且不会被修改
+        changed_parts = {name for name, _, _, _, _ in self.locations}
+        self._pristine = {
+            part: copy.deepcopy(part.element)
+            for part in parts
+            if part is self._doc.part or str(part.partname) in changed_parts
+        }
+
+    @classmethod
+    def load(cls, word_path, cache=None):
+        """
+        优先使用磁盘缓存中的分析结果创建模板，缓存未命中时扫描后写入缓存
+        """
+        cache = cache or template_cache
+        analysis = cache.load(word_path)
+        template = cls(word_path, analysis)
+        if analysis is None:
+            cache.store(word_path, template.analysis())
+        return template
+
+    def analysis(self):
+        return {'placeholders': sorted(self.placeholders), 'locations': [list(location) for location in self.locations]}
+
+    @property
+    def has_repeating_rows(self):
+        # 含重复行的模板结构随数据变化，不能使用XML快速引擎的固定骨架
+        return any(key.startswith(REPEAT_PREFIX) for key in self.placeholders)
+
+    def xml_engine(self, compression_level=None, store_media=False):
+        """
+        返回基于本模板的XML快速引擎，每种打包选项第一次调用时创建，之后复用
+        """
+        key = (compression_level, store_media)
+        if key not in self._xml_engines:
+            self._xml_engines[key] = XmlTemplateEngine(self.word_path, self, compression_level, store_media)
+        return self._xml_engines[key]
+
+    def prune(self):
+        """
+        删除模板中对生成的文档没有用处的内容：缩略图、构建基块（词汇表文档）部件，
+        以及没有被任何段落、表格、编号引用的样式（默认样式和被引用样式的基础样式保留）。
+        只处理一次，返回删除的内容 {'parts': [...], 'styles': 数量}
+        """
+        if self.pruned is not None:
+            return self.pruned
+        from docx.opc.constants import RELATIONSHIP_TYPE as RT
+        from lxml import etree
+        from docx.opc.part import XmlPart
+        from docx.oxml.ns import qn
+        
+        package = self._doc.part.package
+        removed_parts = []
+        for rels in (package.rels, self._doc.part.rels):
+            for rId, rel in list(rels.items()):
+                if rel.reltype in (RT.THUMBNAIL, RT.GLOSSARY_DOCUMENT):
+                    removed_parts.append(str(rel.target_part.partname))
+                    del rels[rId]
+        
+        styles = self._doc.styles.element
+        by_id = {style.get(qn('w:styleId')): style for style in styles.xpath('w:style')}
+        used = set()
+        references = etree.XPath('.//w:pStyle/@w:val | .//w:rStyle/@w:val | .//w:tblStyle/@w:val'
+                                 ' | .//w:numStyleLink/@w:val | .//w:styleLink/@w:val',
+                                 namespaces={'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'})
+        for part in package.iter_parts():
+            # 脚注、尾注、批注等部件 python-docx 不解析（不是 XmlPart），需要从原始内容中查找引用
+            if isinstance(part, XmlPart):
+                element = part.element
+            elif part.content_type.endswith('xml'):
+                element = etree.fromstring(part.blob)
+            else:
+                continue
+            if element is not styles:
+                used.update(references(element))
+        used.update(style_id for style_id, style in by_id.items() if style.get(qn('w:default')) in ('1', 'true'))
+        # 被引用样式所依赖的样式（基础样式、链接样式、后续段落样式）也要保留
+        pending = list(used)
+        while pending:
+            style = by_id.get(pending.pop())
+            if style is None:
+                continue
+            for style_id in style.xpath('w:basedOn/@w:val | w:link/@w:val | w:next/@w:val | .//w:pStyle/@w:val'
+                                        ' | .//w:rStyle/@w:val | .//w:tblStyle/@w:val'):
+                if style_id not in used:
+                    used.add(style_id)
+                    pending.append(style_id)
+        removed_styles = 0
+        for style_id, style in by_id.items():
+            if style_id not in used:
+                styles.remove(style)
+                removed_styles += 1
+        
+        self.pruned = {'parts': removed_parts, 'styles': removed_styles}
+        # 已创建的XML快速引擎基于修剪前的骨架
+        self._xml_engines.clear()
+        return self.pruned
+
+    def new_document(self):
+        """
+        基于原始XML的副本创建一份新文档；返回的文档在下一次调用前有效
+        """
+        for part, element in self._pristine.items():
+            part._element = copy.deepcopy(element)
+        return self._doc.part.document
+
+# 流式写出zip文件，可直接复制已压缩的条目
+class ZipStreamWriter:
+    """
+    最小化的zip写出器：未改动的条目直接复制原压缩字节，改动的条目重新压缩
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.entries = []
+        self.offset = 0
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def write_raw(self, name, raw, crc, file_size, method, date_time):
+        name_bytes = name.encode('utf-8')
+        flags = 0 if name.isascii() else 0x800
+        dos_time = (date_time[3] << 11) | (date_time[4] << 5) | (date_time[5] // 2)
+        dos_date = ((date_time[0] - 1980) << 9) | (date_time[1] << 5) | date_time[2]
+        header_offset = self.offset
+        self._write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, method, dos_time, dos_date,
+                                crc, len(raw), file_size, len(name_bytes), 0))
+        self._write(name_bytes)
+        self._write(raw)
+        self.entries.append((name_bytes, flags, method, dos_time, dos_date, crc, len(raw), file_size, header_offset))
+
+    @staticmethod
+    def compress(data, level=6):
+        """
+        返回 (压缩后的字节, 压缩方式)，level 为 0 时不压缩
+        """
+        if level == 0:
+            return data, zipfile.ZIP_STORED
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(), zipfile.ZIP_DEFLATED
+
+    def write_bytes(self, name, data, date_time, level=6):
+        raw, method = self.compress(data, level)
+        self.write_raw(name, raw, zlib.crc32(data), len(data), method, date_time)
+
+    def close(self):
+        central_offset = self.offset
+        for name_bytes, flags, method, dos_time, dos_date, crc, compress_size, file_size, header_offset in self.entries:
+            self._write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, method, dos_time, dos_date,
+                                    crc, compress_size, file_size, len(name_bytes), 0, 0, 0, 0, 0, header_offset))
+            self._write(name_bytes)
+        self._write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                                self.offset - central_offset, central_offset, 0))
+
+# 已经压缩过的媒体格式，再用 deflate 压缩几乎不会变小，只会消耗CPU
+COMPRESSED_MEDIA_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.jpe', '.jfif', '.gif', '.wdp', '.hdp', '.mp3', '.mp4', '.m4a'}
+
+# 条目使用的压缩级别：0 表示不压缩（存储）
+def entry_compression_level(name, compression_level=None, store_media=False):
+    if store_media and os.path.splitext(name)[1].lower() in COMPRESSED_MEDIA_EXTENSIONS:
+        return 0
+    return 6 if compression_level is None else compression_level
+
+# 按指定的压缩级别保存文档
+def save_document(doc, fileobj, compression_level=None, store_media=False):
+    """
+    与 doc.save 写出相同的部件，但每个条目按 entry_compression_level 压缩；
+    两个选项都是默认值时直接使用 doc.save
+    """
+    if compression_level is None and not store_media:
+        doc.save(fileobj)
+        return
+    from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+    from docx.opc.pkgwriter import _ContentTypesItem
+    
+    package = doc.part.package
+    parts = list(package.iter_parts())
+    for part in parts:
+        part.before_marshal()
+    writer = ZipStreamWriter(fileobj)
+    date_time = time.localtime()[:6]
+    
+    def write(uri, blob):
+        name = uri.membername
+        writer.write_bytes(name, blob, date_time, entry_compression_level(name, compression_level, store_media))
+    
+    write(CONTENT_TYPES_URI, _ContentTypesItem.from_parts(parts).blob)
+    write(PACKAGE_URI.rels_uri, package.rels.xml)
+    for part in parts:
+        write(part.partname, part.blob)
+        if len(part.rels):
+            write(part.partname.rels_uri, part.rels.xml)
+    writer.close()
+
+# XML层面的流式渲染引擎
+class XmlTemplateEngine:
+    """
+    直接在OOXML压缩包上渲染：正文、页眉、页脚部件预先拆分为固定片段和占位槽，
+    每行只重新写入含占位符的部件，其余部件（样式、主题、图片、字体等）直接复制已压缩的字节。
+    指定了打包选项时，其余部件在创建引擎时按选项重新压缩一次。
+    keys 为占位槽对应的字段，默认为模板中的所有占位符；不在其中的占位符保持模板原样
+    """
+    slot_pattern = re.compile('\ue000(\\d+)\ue001')
+    # XML 1.0 不允许的字符（制表符、换行、回车除外的控制字符、代理项、U+FFFE/U+FFFF）
+    illegal_char_pattern = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+    def __init__(self, word_path, compiled=None, compression_level=None, store_media=False, keys=None):
+        self.word_path = word_path
+        self.compression_level = compression_level
+        self.store_media = store_media
+        compiled = compiled or CompiledTemplate(word_path)
+        self._compiled = compiled
+        # 缺少部分字段时使用的骨架，键为缺少的字段集合
+        self._variants = {}
+        
+        # 用唯一标记替换占位符，得到与 replace_placeholders 结构一致的骨架文档
+        self.keys = sorted(compiled.placeholders if keys is None else keys)
+        markers = {key: f"\ue000{idx}\ue001" for idx, key in enumerate(self.keys)}
+        doc = compiled.new_document()
+        replace_placeholders(doc, markers)
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        skeleton = buffer.getvalue()
+        
+        # 每个元素为 (条目名, 原始压缩字节, crc, 原始大小, 压缩方式, 时间) 或 (条目名, 片段列表, 时间)
+        self.entries = []
+        with zipfile.ZipFile(io.BytesIO(skeleton)) as zf:
+            for info in zf.infolist():
+                if info.filename.endswith('.xml'):
+                    xml_text = zf.read(info).decode('utf-8')
+                    if '\ue000' in xml_text:
+                        self.entries.append((info.filename, self._split_segments(xml_text), info.date_time))
+                        continue
+                
+                if compression_level is not None or store_media:
+                    raw, method = ZipStreamWriter.compress(
+                        zf.read(info), entry_compression_level(info.filename, compression_level, store_media))
+                    self.entries.append((info.filename, raw, info.CRC, info.file_size, method, info.date_time))
+                    continue
+                
+                # 跳过本地文件头，截取已压缩的数据
+                name_len, extra_len = struct.unpack('<HH', skeleton[info.header_offset + 26:info.header_offset + 30])
+                data_start = info.header_offset + 30 + name_len + extra_len
+                raw = skeleton[data_start:data_start + info.compress_size]
+                self.entries.append((info.filename, raw, info.CRC, info.file_size, info.compress_type, info.date_time))
+
+    def _split_segments(self, xml_text):
+        # 占位槽所在的 w:t 必须保留空格，否则替换值首尾的空格会被 Word 忽略
+        xml_text = re.sub('<w:t>(?=[^<]*\ue000)', '<w:t xml:space="preserve">', xml_text)
+        segments = []
+        pos = 0
+        for match in self.slot_pattern.finditer(xml_text):
+            segments.append(xml_text[pos:match.start()].encode('utf-8'))
+            segments.append(self.keys[int(match.group(1))])
+            pos = match.end()
+        segments.append(xml_text[pos:].encode('utf-8'))
+        return segments
+
+    @classmethod
+    def _escape(cls, value):
+        text = str(value)
+        # 直接写入会生成无法打开的文档，报错后该行记入问题列表
+        illegal = cls.illegal_char_pattern.search(text)
+        if illegal:
+            raise ValueError(f"值中含有 XML 不允许的字符 U+{ord(illegal.group()):04X}：{text!r}")
+        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        # 与 python-docx 一致：制表符转为 w:tab，换行转为 w:br
+        text = text.replace('\t', '</w:t><w:tab/><w:t xml:space="preserve">')
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return text.replace('\n', '</w:t><w:br/><w:t xml:space="preserve">').encode('utf-8')
+
+    def render_to(self, fileobj, replacements):
+        """
+        将替换后的文档写入文件对象，返回替换的占位符数量
+        """
+        missing = frozenset(key for key in self.keys if key not in replacements)
+        if missing:
+            return self._variant(missing).render_to(fileobj, replacements)
+        
+        replaced_count = 0
+        writer = ZipStreamWriter(fileobj)
+        for entry in self.entries:
+            if len(entry) == 6:
+                writer.write_raw(*entry)
+                continue
+            name, segments, date_time = entry
+            chunks = []
+            for idx, segment in enumerate(segments):
+                if idx % 2 == 0:
+                    chunks.append(segment)
+                else:
+                    chunks.append(self._escape(replacements[segment]))
+                    replaced_count += 1
+            writer.write_bytes(name, b''.join(chunks), date_time,
+                               entry_compression_level(name, self.compression_level, self.store_media))
+        writer.close()
+        return replaced_count
+
+    def _variant(self, missing):
+        """
+        返回不替换 missing 中字段的骨架引擎。跨run的占位符在骨架中已合并到一个run，
+        缺少数据时不能简单地写回占位符文本，而要与 replace_placeholders 一样保留模板原样。
+        同一批数据缺少的字段通常相同，每种组合只创建一次
+        """
+        if missing not in self._variants:
+            self._variants[missing] = XmlTemplateEngine(
+                self.word_path, self._compiled, self.compression_level, self.store_media,
+                keys=[key for key in self.keys if key not in missing])
+        return self._variants[missing]
+
+# 按文件修改时间失效的LRU缓存
+class FileLRUCache:
+    """
+    以文件绝对路径为键缓存 loader(path) 的结果；文件的修改时间或大小变化时重新加载，
+    超过 capacity 个文件时淘汰最久未用的。可在多个线程中使用
+    """
+    def __init__(self, loader, capacity=8):
+        self.loader = loader
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # 加载可能较慢，不持有锁
+        value = self.loader(path)
+        with self._lock:
+            self._entries[path] = (version, value)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return value
+
+    def info(self):
+        with self._lock:
+            return {'entries': list(self._entries), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses}
+
+# 同一模板的若干已解析副本
+class TemplatePool:
+    """
+    CompiledTemplate 同一时间只能生成一份文档，并行的任务各取一份副本，用完放回
+    """
+    def __init__(self, word_path):
+        self.word_path = word_path
+        self._lock = threading.Lock()
+        # 先解析一份，模板有问题时加载阶段就报错
+        self._idle = [CompiledTemplate.load(word_path)]
+
+    @contextlib.contextmanager
+    def checkout(self):
+        with self._lock:
+            template = self._idle.pop() if self._idle else None
+        if template is None:
+            template = CompiledTemplate.load(self.word_path)
+        try:
+            yield template
+        finally:
+            with self._lock:
+                self._idle.append(template)
+
+# 生成安全的文件名
+def make_safe_filename(name_formatted, index):
+    """
+    替换文件名中的非法字符，为空时使用默认名称
+    """
+    name_str = str(name_formatted).strip().replace("/", "_").replace("\\", "_").replace(":", "_").replace("*", "_").replace("?", "_").replace("\"", "_").replace("<", "_").replace(">", "_").replace("|", "_")
+    
+    # 如果文件名为空，使用默认名称
+    if not name_str or name_str.isspace():
+        name_str = f"document_{index+1}"
+    return name_str
+
+# 工作进程的状态；常驻服务中多个任务线程同时生成时，每个线程各用各的
+class _ThreadState(threading.local):
+    def __init__(self):
+        self.values = {}
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def clear(self):
+        self.values.clear()
+
+# 每个工作进程只加载一次模板
+_worker_state = _ThreadState()
+
+def _init_worker(word_path, use_xml_engine, profile_every=0, profile_dir=None, template=None,
+                 template_pool_size=16, compression_level=None, store_media=False, prune_parts=False):
+    def load_template(path):
+        loaded = CompiledTemplate.load(path)
+        if prune_parts:
+            loaded.prune()
+        return loaded
+    
+    if template is None and word_path:
+        template = load_template(word_path)
+    if template is not None and use_xml_engine and not template.has_repeating_rows:
+        template.xml_engine(compression_level, store_media)
+    _worker_state['template'] = template
+    # 按行选择的模板：每个进程内每个模板只解析一次，超出容量时淘汰最久未用的
+    _worker_state['templates'] = FileLRUCache(load_template, template_pool_size)
+    _worker_state['use_xml_engine'] = use_xml_engine
+    _worker_state['package'] = (compression_level, store_media)
+    _worker_state['profile_every'] = profile_every
+    _worker_state['profile_dir'] = profile_dir
+
+# 生成单份文档，返回 (行指标, 文档字节)；给出 output_path 时直接写入文件，不返回字节。
+# template_path 为 None 时使用默认模板
+def _render_row(row_data, output_path=None, template_path=None):
+    row_metrics = {}
+    buffer = io.BytesIO()
+    started = time.perf_counter()
+    if template_path is None:
+        template = _worker_state['template']
+    else:
+        template = _worker_state['templates'].get(template_path)
+        row_metrics['load_template'] = time.perf_counter() - started
+        started = time.perf_counter()
+    repeating = template.has_repeating_rows
+    package = _worker_state['package']
+    xml_engine = template.xml_engine(*package) if _worker_state['use_xml_engine'] and not repeating else None
+    if xml_engine is not None:
+        row_metrics['replaced'] = xml_engine.render_to(buffer, row_data)
+        row_metrics['xml_render'] = time.perf_counter() - started
+    else:
+        doc = template.new_document()
+        row_metrics['clone'] = time.perf_counter() - started
+        started = time.perf_counter()
+        row_metrics['replaced'] = 0
+        if repeating:
+            # 分组时按组内所有记录展开，未分组时重复行只填入本行
+            records = getattr(row_data, 'records', None) or [row_data]
+            row_metrics['replaced'] += expand_repeating_rows(doc, records)
+        row_metrics['replaced'] += replace_placeholders(doc, row_data)
+        row_metrics['replace'] = time.perf_counter() - started
+        started = time.perf_counter()
+        save_document(doc, buffer, *package)
+        row_metrics['save'] = time.perf_counter() - started
+    data = buffer.getvalue()
+    row_metrics['bytes'] = len(data)
+    if output_path is None:
+        return row_metrics, data
+    started = time.perf_counter()
+    write_file_atomic(output_path, data)
+    row_metrics['write'] = time.perf_counter() - started
+    return row_metrics, None
+
+# 处理一个分片，返回每行的 (行号, 错误信息, 行指标, 文档字节)
+def _render_chunk(chunk):
+    results = []
+    profile_every = _worker_state.get('profile_every')
+    profiler = None
+    for i, row_data, output_path, template_path in chunk:
+        sampled = profile_every and i % profile_every == 0
+        if sampled:
+            profiler = profiler or cProfile.Profile()
+            profiler.enable()
+        try:
+            results.append((i, None, *_render_row(row_data, output_path, template_path)))
+        except Exception as e:
+            results.append((i, str(e), None, None))
+        finally:
+            if sampled:
+                profiler.disable()
+    # 采样结果写入临时目录，由主进程合并
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(_worker_state['profile_dir'], f"{os.getpid()}-{chunk[0][0]}.prof"))
+    return results
+
+# 计算文件内容指纹
+def file_fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# 计算一行数据的内容哈希（包含模板指纹，模板变化时所有行都需要重新生成）
+def row_fingerprint(row_data, template_fingerprint):
+    records = getattr(row_data, 'records', None) or [row_data]
+    payload = json.dumps([[[str(key), str(value)] for key, value in record.items()] for record in records],
+                         ensure_ascii=False)
+    return hashlib.sha256(f"{template_fingerprint}\n{payload}".encode('utf-8')).hexdigest()
+
+# 增量生成清单
+class MergeManifest:
+    """
+    记录每个输出文件对应的行内容哈希。每生成一份文档就追加一行并立即写盘，
+    程序中途崩溃后，已完成的记录仍然有效，重新运行时可以从中断处继续
+    """
+    file_name = ".mailmerge_manifest.jsonl"
+
+    def __init__(self, output_dir, file_name=None):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, file_name or self.file_name)
+        # 文件名 -> {"row": 行号, "hash": 内容哈希}
+        self.entries = {}
+        self._file = None
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 崩溃时最后一行可能不完整
+                        continue
+                    if record.get('hash'):
+                        self.entries[record['file']] = {'row': record['row'], 'hash': record['hash']}
+                    else:
+                        self.entries.pop(record['file'], None)
+
+    def is_current(self, file_name, row_hash):
+        """
+        内容哈希未变化且输出文件仍然存在时返回 True
+        """
+        entry = self.entries.get(file_name)
+        return (entry is not None and entry['hash'] == row_hash
+                and os.path.exists(os.path.join(self.output_dir, file_name)))
+
+    def _append(self, record):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def record(self, file_name, row, row_hash):
+        self.entries[file_name] = {'row': row, 'hash': row_hash}
+        self._append({'file': file_name, 'row': row, 'hash': row_hash})
+
+    def discard(self, file_name):
+        if self.entries.pop(file_name, None) is not None:
+            self._append({'file': file_name, 'row': None, 'hash': None})
+
+    def close(self):
+        """
+        关闭追加写入，并把清单压缩为每个文件一行
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for file_name, entry in self.entries.items():
+                f.write(json.dumps({'file': file_name, **entry}, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
+
+# 输出方式
+OUTPUT_MODES = {
+    'files': '每行一个 Word 文件',
+    'zip': '打包为一个 zip 文件',
+    'combined': '合并为一个 Word 文档（便于批量打印）',
+}
+
+# 进程的 umask：os.umask 只能先设置再恢复，写线程中不能调用，启动时读取一次
+def _read_umask():
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+_UMASK = _read_umask()
+
+# 先写入同目录下的临时文件再重命名，中途失败不会留下不完整的文档
+def write_file_atomic(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # mkstemp 创建的文件只有本人可读写，改为与直接创建文件相同的权限，共享目录中的其他用户才能读取
+        os.chmod(temp_path, 0o666 & ~_UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+# 后台写文件
+class AsyncFileWriter:
+    """
+    有界队列加若干写线程：生成和写盘重叠进行。队列满时 submit 阻塞，
+    生成速度不会超过写盘速度太多；写完的结果通过 completed() 取回
+    """
+    def __init__(self, threads=2, max_pending=16):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._done = queue.Queue()
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, row, path, data):
+        self._queue.put((row, path, data))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            row, path, data = item
+            started = time.perf_counter()
+            try:
+                write_file_atomic(path, data)
+                error = None
+            except Exception as e:
+                error = str(e)
+            self._done.put((row, error, time.perf_counter() - started))
+
+    def completed(self):
+        """
+        返回目前已写完的 (行号, 错误信息, 写入耗时) 列表
+        """
+        results = []
+        while True:
+            try:
+                results.append(self._done.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self):
+        # 等待队列中剩余的文件写完
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+# 输出目标的基类
+class OutputSink:
+    """
+    write() 接收一行生成的文档字节，completed() 取回已写完的 (行号, 错误信息, 写入耗时)。
+    子类实现 _write()，在调用线程中同步写入
+    """
+    per_file = False
+
+    def __init__(self, path):
+        self.path = path
+        self._completed = []
+
+    def target(self, file_name):
+        """
+        返回工作进程直接写入的路径；为 None 时工作进程返回文档字节，由 write() 写出
+        """
+        return None
+
+    def write(self, row, file_name, data):
+        started = time.perf_counter()
+        try:
+            self._write(file_name, data)
+            error = None
+        except Exception as e:
+            error = str(e)
+        self._completed.append((row, error, time.perf_counter() - started))
+
+    def completed(self):
+        results, self._completed = self._completed, []
+        return results
+
+    def close(self):
+        pass
+
+# 逐个文件输出
+class FileSink(OutputSink):
     """
-    根据Excel单元格格式对数据进行格式化
+    每行一个 .docx 文件。writer_threads 大于0时由后台写线程写入，与生成重叠进行；
+    为0时由工作进程直接写入
     """
-    if cell.value is None:
-        return ""
-    
-    # 获取单元格格式
-    format_code = cell.number_format
-    value = cell.value
-    
-    # 处理文本格式
-    if isinstance(value, str):
-        return value
-    
-    # 处理日期时间类型
-    if isinstance(value, (datetime.datetime, datetime.date)):
-        if hasattr(value, 'hour') and (value.hour != 0 or value.minute != 0 or value.second != 0):
-            return value.strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            return value.strftime('%Y-%m-%d')
-    
-    # 处理数字类型
-    if isinstance(value, (int, float)):
-        # 处理前导零格式 (如 "000")
-        if format_code.startswith('0') and not any(c != '0' for c in format_code):
-            width = len(format_code)
-            if isinstance(value, int) or value.is_integer():
-                return str(int(value)).zfill(width)
-        
-        # 处理货币格式
-        if any(s in format_code for s in ['¥', '$', '€', '￥']):
-            decimal_places = 2  # 默认保留2位小数
-            if '.' in format_code:
-                # 尝试从格式中提取小数位数
-                decimal_part = format_code.split('.')[-1]
-                if '0' in decimal_part:
-                    decimal_places = decimal_part.count('0')
-            
-            # 获取货币符号
-            symbol = '¥'  # 默认人民币符号
-            for s in ['¥', '$', '€', '￥']:
-                if s in format_code:
-                    symbol = s
-                    break
-            
-            if value.is_integer() and decimal_places == 0:
-                return f"{symbol}{int(value):,}"
-            else:
-                return f"{symbol}{value:,.{decimal_places}f}"
-        
-        # 处理带千分位的数字
-        if '#,##0' in format_code or '#,###' in format_code:
-            decimal_places = 0
-            if '.' in format_code:
-                decimal_part = format_code.split('.')[-1]
-                if '0' in decimal_part:
-                    decimal_places = decimal_part.count('0')
-            
-            if value.is_integer() and decimal_places == 0:
-                return f"{int(value):,}"
+    per_file = True
+
+    def __init__(self, output_dir, writer_threads=2, max_pending=None):
+        super().__init__(output_dir)
+        self.output_dir = output_dir
+        self._writer = None
+        if writer_threads > 0:
+            self._writer = AsyncFileWriter(writer_threads, max_pending or writer_threads * 8)
+
+    def target(self, file_name):
+        return None if self._writer is not None else os.path.join(self.output_dir, file_name)
+
+    def write(self, row, file_name, data):
+        self._writer.submit(row, os.path.join(self.output_dir, file_name), data)
+
+    def completed(self):
+        return self._writer.completed() if self._writer is not None else []
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+# 打包输出
+class ZipSink(OutputSink):
+    """
+    所有文档依次写入同一个 zip 文件，不产生临时的 .docx 文件。
+    .docx 本身已经压缩，zip 中直接存储
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self._temp_path = path + ".part"
+        self._zip = zipfile.ZipFile(self._temp_path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+        self._names = set()
+
+    def _write(self, file_name, data):
+        # 文件名重复时追加序号，避免 zip 中出现同名条目
+        name = file_name
+        stem, ext = os.path.splitext(file_name)
+        count = 1
+        while name in self._names:
+            count += 1
+            name = f"{stem} ({count}){ext}"
+        self._names.add(name)
+        self._zip.writestr(zipfile.ZipInfo(name, time.localtime()[:6]), data)
+
+    def close(self):
+        self._zip.close()
+        os.replace(self._temp_path, self.path)
+
+# 合并为一个Word文档
+class CombinedDocumentSink(OutputSink):
+    """
+    把每份文档的正文依次追加到同一个 .docx 中，文档之间插入分节符。
+    正文先写入临时文件，结束时再与样式、图片等部件一起打包，内存占用不随行数增长。
+    页眉页脚的内容与第一份文档不同时（含占位符），每份文档的页眉页脚另存为新部件
+    """
+    relationship_types = {
+        'w:headerReference': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/header',
+        'w:footerReference': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/footer',
+    }
+    content_types = {
+        'w:headerReference': 'application/vnd.openxmlformats-officedocument.wordprocessingml.header+xml',
+        'w:footerReference': 'application/vnd.openxmlformats-officedocument.wordprocessingml.footer+xml',
+    }
+    rewritten_parts = ('[Content_Types].xml', 'word/document.xml', 'word/_rels/document.xml.rels')
+    paragraph_id_attributes = ('{http://schemas.microsoft.com/office/word/2010/wordml}paraId',
+                               '{http://schemas.microsoft.com/office/word/2010/wordml}textId')
+    # 域代码中引用书签的位置，如 REF OLE_LINK1、PAGEREF _Toc123
+    bookmark_reference_pattern = re.compile(r'(\b(?:REF|PAGEREF|NOTEREF)\s+)(\S+)')
+
+    def __init__(self, path, compression_level=None, store_media=False):
+        from lxml import etree
+        from docx.oxml.ns import qn
+        
+        super().__init__(path)
+        self._etree = etree
+        self._qn = qn
+        self.compression_level = compression_level
+        self.store_media = store_media
+        self._temp_path = path + ".part"
+        # 默认压缩方式用于流式写入的 document.xml，其余条目由 _zip_write 按条目决定
+        self._zip = zipfile.ZipFile(self._temp_path, 'w',
+                                    zipfile.ZIP_STORED if compression_level == 0 else zipfile.ZIP_DEFLATED,
+                                    allowZip64=True, compresslevel=compression_level or None)
+        self._body = tempfile.TemporaryFile()
+        # 第一份文档：样式、图片等共享部件和 document.xml 的首尾都取自它
+        self._base = None
+        self._base_parts = {}
+        self._prefix = self._suffix = b''
+        # 上一份文档的最后一个元素和节属性，等下一份文档到来时再写出分节符
+        self._pending = None
+        # 新增的页眉页脚部件 (关系ID, 部件名, 引用标签)
+        self._parts = []
+        self._drawing_id = 0
+        self._bookmark_id = 0
+        self._documents = 0
+
+    def _write(self, file_name, data):
+        qn = self._qn
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            root = self._etree.fromstring(zf.read('word/document.xml'))
+            body = root.find(qn('w:body'))
+            if self._base is None:
+                self._base = zipfile.ZipFile(io.BytesIO(data))
             else:
-                return f"{value:,.{decimal_places}f}"
-        
-        # 处理百分比
-        if '%' in format_code:
-            decimal_places = 0
-            if '.' in format_code:
-                decimal_part = format_code.split('.')[-1]
-                if '0' in decimal_part:
-                    decimal_places = decimal_part.count('0')
-            return f"{value*100:.{decimal_places}f}%"
+                self._copy_header_footer_parts(zf, body)
         
-        # 处理普通数字
-        if value.is_integer():
-            return str(int(value))
+        self._renumber_ids(body)
         
-        # 移除不必要的小数点和尾随零
-        return str(value).rstrip('0').rstrip('.') if '.' in str(value) else str(value)
-    
-    # 其他情况，转换为字符串
-    return str(value)
+        children = list(body)
+        sect_pr = children.pop() if children and children[-1].tag == qn('w:sectPr') else None
+        if self._pending is not None:
+            self._flush_pending(section_break=True)
+        for child in children[:-1]:
+            self._body.write(self._etree.tostring(child, encoding='utf-8'))
+        self._pending = (children[-1] if children else None, sect_pr)
+        
+        if not self._prefix:
+            for child in list(body):
+                body.remove(child)
+            shell = self._etree.tostring(root, encoding='UTF-8', xml_declaration=True, standalone=True)
+            self._prefix, self._suffix = shell.split(b'<w:body/>')
 
-# 读取Excel数据和格式信息
-def read_excel_with_format(excel_path):
+    def _renumber_ids(self, body):
+        """
+        每份文档都来自同一个模板，绘图对象编号、书签编号和名称、段落标识都会重复，
+        合并前改为在整个文档内唯一
+        """
+        qn = self._qn
+        self._documents += 1
+        for doc_pr in body.iter(qn('wp:docPr')):
+            self._drawing_id += 1
+            doc_pr.set('id', str(self._drawing_id))
+        
+        # 书签编号按份重新分配，首尾按原编号对应；名称加上份号后缀（第一份保持不变）
+        ids, names = {}, {}
+        for bookmark in body.iter(qn('w:bookmarkStart'), qn('w:bookmarkEnd')):
+            old_id = bookmark.get(qn('w:id'))
+            if old_id not in ids:
+                self._bookmark_id += 1
+                ids[old_id] = str(self._bookmark_id)
+            bookmark.set(qn('w:id'), ids[old_id])
+            name = bookmark.get(qn('w:name'))
+            if name is not None and self._documents > 1:
+                suffix = f"_{self._documents}"
+                # Word 的书签名称最长 40 个字符
+                names[name] = name[:40 - len(suffix)] + suffix
+                bookmark.set(qn('w:name'), names[name])
+        if names:
+            for link in body.iter(qn('w:hyperlink')):
+                anchor = link.get(qn('w:anchor'))
+                if anchor in names:
+                    link.set(qn('w:anchor'), names[anchor])
+            for instr in body.iter(qn('w:instrText')):
+                if instr.text:
+                    instr.text = self.bookmark_reference_pattern.sub(
+                        lambda m: m.group(1) + names.get(m.group(2), m.group(2)), instr.text)
+        
+        # 段落标识（w14:paraId、w14:textId）是可选属性，重复时 Word 会报错，直接去掉
+        for element in body.iter():
+            for attribute in self.paragraph_id_attributes:
+                if attribute in element.attrib:
+                    del element.attrib[attribute]
+
+    def _copy_header_footer_parts(self, zf, body):
+        """
+        把本份文档中与第一份文档不同的页眉页脚另存为新部件，并改写节属性中的引用
+        """
+        qn = self._qn
+        rels = self._etree.fromstring(zf.read('word/_rels/document.xml.rels'))
+        targets = {rel.get('Id'): rel.get('Target') for rel in rels}
+        for reference in body.iter(qn('w:headerReference'), qn('w:footerReference')):
+            part_name = 'word/' + targets[reference.get(qn('r:id'))]
+            content = zf.read(part_name)
+            if part_name not in self._base_parts:
+                self._base_parts[part_name] = self._base.read(part_name)
+            if self._base_parts[part_name] == content:
+                continue
+            kind = 'w:headerReference' if reference.tag == qn('w:headerReference') else 'w:footerReference'
+            new_name = f"mm_{kind[2:8]}{len(self._parts) + 1}.xml"
+            rel_id = f"rIdMm{len(self._parts) + 1}"
+            self._zip_write('word/' + new_name, content)
+            # 页眉页脚中的图片等关系一并复制，目标路径相同
+            rels_name = f"word/_rels/{os.path.basename(part_name)}.rels"
+            if rels_name in zf.namelist():
+                self._zip_write(f"word/_rels/{new_name}.rels", zf.read(rels_name))
+            reference.set(qn('r:id'), rel_id)
+            self._parts.append((rel_id, new_name, kind))
+
+    def _zip_write(self, name, data):
+        level = entry_compression_level(name, self.compression_level, self.store_media)
+        if level == 0:
+            self._zip.writestr(name, data, zipfile.ZIP_STORED)
+        else:
+            self._zip.writestr(name, data, zipfile.ZIP_DEFLATED, level)
+
+    def _flush_pending(self, section_break):
+        """
+        写出上一份文档的最后一个元素；section_break 为 True 时把它的节属性
+        放到最后一个段落中，使下一份文档从新的一节开始
+        """
+        qn = self._qn
+        last, sect_pr = self._pending
+        self._pending = None
+        if section_break and sect_pr is not None:
+            p_pr = last.find(qn('w:pPr')) if last is not None and last.tag == qn('w:p') else None
+            if last is not None and last.tag == qn('w:p') and (p_pr is None or p_pr.find(qn('w:sectPr')) is None):
+                if p_pr is None:
+                    p_pr = self._etree.Element(qn('w:pPr'))
+                    last.insert(0, p_pr)
+                change = p_pr.find(qn('w:pPrChange'))
+                if change is not None:
+                    change.addprevious(sect_pr)
+                else:
+                    p_pr.append(sect_pr)
+                sect_pr = None
+        if last is not None:
+            self._body.write(self._etree.tostring(last, encoding='utf-8'))
+        if section_break and sect_pr is not None:
+            # 最后一个元素不是段落（如表格）时，单独加一个段落承载分节符
+            self._body.write(b'<w:p><w:pPr>' + self._etree.tostring(sect_pr, encoding='utf-8') + b'</w:pPr></w:p>')
+
+    def close(self):
+        try:
+            if self._base is not None:
+                self._finish()
+                self._base.close()
+        finally:
+            self._body.close()
+            self._zip.close()
+        if self._base is None:
+            # 没有成功生成任何文档时不留下只有空压缩包的 .docx
+            os.remove(self._temp_path)
+            return
+        os.replace(self._temp_path, self.path)
+
+    def _finish(self):
+        qn = self._qn
+        final_sect_pr = self._pending[1]
+        self._pending = (self._pending[0], None)
+        self._flush_pending(section_break=False)
+        
+        for info in self._base.infolist():
+            if info.filename not in self.rewritten_parts:
+                self._zip_write(info.filename, self._base.read(info))
+        
+        rels = self._etree.fromstring(self._base.read('word/_rels/document.xml.rels'))
+        content_types = self._etree.fromstring(self._base.read('[Content_Types].xml'))
+        for rel_id, new_name, kind in self._parts:
+            self._etree.SubElement(rels, '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship',
+                                   Id=rel_id, Type=self.relationship_types[kind], Target=new_name)
+            self._etree.SubElement(content_types, '{http://schemas.openxmlformats.org/package/2006/content-types}Override',
+                                   PartName='/word/' + new_name, ContentType=self.content_types[kind])
+        self._zip_write('[Content_Types].xml', self._etree.tostring(
+            content_types, encoding='UTF-8', xml_declaration=True, standalone=True))
+        self._zip_write('word/_rels/document.xml.rels', self._etree.tostring(
+            rels, encoding='UTF-8', xml_declaration=True, standalone=True))
+        
+        # 正文从临时文件流式写入
+        body_size = self._body.tell()
+        self._body.seek(0)
+        with self._zip.open('word/document.xml', 'w', force_zip64=body_size > 0x7fffffff) as dest:
+            dest.write(self._prefix + b'<w:body>')
+            shutil.copyfileobj(self._body, dest, 1024 * 1024)
+            if final_sect_pr is not None:
+                dest.write(self._etree.tostring(final_sect_pr, encoding='utf-8'))
+            dest.write(b'</w:body>' + self._suffix)
+
+# 合并为一个文档时所有文档共用第一份的样式和部件，不同模板的文档不能合并
+COMBINED_TEMPLATE_COLUMN_ERROR = "按模板列选择模板时不能合并为一个 Word 文档，请改用逐个文件或 zip 打包输出"
+
+# 根据输出方式创建输出目标
+def open_output_sink(output_mode, output_dir, word_path, writer_threads=2, name_suffix="",
+                     compression_level=None, store_media=False):
+    # 只按模板列选择模板、没有默认模板时使用通用名称
+    stem = os.path.splitext(os.path.basename(word_path))[0] if word_path else "邮件合并"
+    if output_mode == 'zip':
+        return ZipSink(os.path.join(output_dir, f"{stem}_合并{name_suffix}.zip"))
+    if output_mode == 'combined':
+        return CombinedDocumentSink(os.path.join(output_dir, f"{stem}_合并{name_suffix}.docx"),
+                                    compression_level, store_media)
+    if output_mode != 'files':
+        raise ValueError(f"未知的输出方式：{output_mode}")
+    return FileSink(output_dir, writer_threads)
+
+# 合并各进程的 cProfile 采样结果
+def _merge_profiles(profile_dir, profile_path):
+    files = [os.path.join(profile_dir, name) for name in os.listdir(profile_dir)]
+    if files and profile_path:
+        pstats.Stats(*files).dump_stats(profile_path)
+    for path in files:
+        os.remove(path)
+    os.rmdir(profile_dir)
+
+# 分组后的一组数据
+class GroupRecord(dict):
+    """
+    内容为组内第一行的数据（用于普通占位符），records 为组内所有行（用于重复行）
+    """
+    def __init__(self, records):
+        super().__init__(records[0])
+        self.records = [dict(record) for record in records]
+
+# 按分组列把行分组
+def group_rows(formatted_data, group_column):
+    """
+    返回各组的行号列表，按每组第一次出现的顺序排列；分组列为空的行各自成组
+    """
+    groups = {}
+    for i, key in enumerate(column_values(formatted_data, group_column)):
+        if not str(key).strip():
+            key = (None, i)
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+# 第 position 份文档（从0开始）对应的 (行号, 数据)
+def document_row_data(formatted_data, groups, position):
+    """
+    groups 为 group_rows 的结果时每组一份文档（以组内第一行为行号），为 None 时每行一份
+    """
+    if groups:
+        rows = groups[position]
+        return rows[0], GroupRecord([formatted_data[row] for row in rows])
+    return position, formatted_data[position]
+
+# 按模板列确定每行使用的模板
+def resolve_row_templates(formatted_data, template_column, template_dir, default_template=None):
+    """
+    模板列的值可以是模板路径，也可以是 template_dir 中的文件名（可省略 .docx 扩展名）；
+    值为空的行使用 default_template。返回每行模板的绝对路径列表，没有可用模板的行为 None
+    """
+    default = os.path.abspath(default_template) if default_template else None
+    paths = {}
+    row_templates = []
+    for value in column_values(formatted_data, template_column):
+        value = str(value).strip()
+        if value not in paths:
+            if not value:
+                paths[value] = default
+            else:
+                name = value if os.path.splitext(value)[1] else value + ".docx"
+                paths[value] = os.path.abspath(os.path.join(template_dir or "", name))
+        row_templates.append(paths[value])
+    return row_templates
+
+# 逐个模板检查占位符与列的映射
+def check_template_mapping(columns, row_templates):
+    """
+    返回 {模板路径: {'rows': 使用的行数, 'missing_fields': [...]}}，
+    模板不存在或无法读取时记录 error 而不是 missing_fields
+    """
+    column_set = set(columns)
+    results = {}
+    for path, rows in collections.Counter(row_templates).items():
+        if path is None:
+            results[None] = {'rows': rows, 'error': "没有指定模板"}
+            continue
+        if not os.path.isfile(path):
+            results[path] = {'rows': rows, 'error': "模板不存在"}
+            continue
+        try:
+            placeholders = template_cache.placeholders(path)
+        except Exception as e:
+            results[path] = {'rows': rows, 'error': str(e)}
+            continue
+        results[path] = {
+            'rows': rows,
+            'placeholders': sorted(placeholders),
+            'missing_fields': sorted(field for field in placeholders if placeholder_column(field) not in column_set),
+        }
+    return results
+
+# 解析分片参数，如 "2/4" 表示共 4 个分片中的第 2 个
+def parse_shard(text):
+    index, _, count = text.partition('/')
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError(f"分片编号应在 1 到 {count} 之间：{text}")
+    return index, count
+
+# 按输出文件名分配分片（编号从1开始）：同名文件（不区分大小写）总在同一分片，各分片之间不会重复输出
+def shard_of(file_name, shard_count):
+    return zlib.crc32(file_name.casefold().encode('utf-8')) % shard_count + 1
+
+# 分片的清单、摘要等文件名
+def shard_file_name(prefix, shard, ext):
+    return f"{prefix}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+SUMMARY_PREFIX = ".mailmerge_summary"
+
+# 与 executor.map 相同按顺序返回结果，但最多同时提交 window 个任务
+def _bounded_map(executor, fn, items, window):
+    items = iter(items)
+    futures = collections.deque(executor.submit(fn, item) for item in itertools.islice(items, window))
+    while futures:
+        result = futures.popleft().result()
+        for item in itertools.islice(items, 1):
+            futures.append(executor.submit(fn, item))
+        yield result
+
+# 批量生成文档
+def generate_documents(word_path, formatted_data, output_names, output_dir, workers=1,
+                       use_xml_engine=False, progress_callback=None, stats=None, cancel_event=None,
+                       incremental=False, metrics=None, output_mode='files', writer_threads=2,
+                       group_column=None, shard=None, template=None, template_column=None,
+                       template_dir=None, template_pool_size=16, compression_level=None, store_media=False,
+                       prune_parts=False):
     """
-    同时读取Excel数据和单元格格式信息
+    按行生成文档，workers 大于1时将数据分片交给多个进程并行处理。
+    progress_callback(已完成数, 总数) 按行顺序回调；传入 stats 字典时记录各阶段耗时（秒）。
+    cancel_event 被设置后在当前文档（并行时为当前分片）完成后停止，并在 stats 中记录 cancelled。
+    incremental 为 True 时根据输出目录中的清单跳过内容未变化且文件仍存在的行，
+    跳过的行数记录在 stats['skipped']。metrics 为 MergeMetrics 时记录每行的详细指标。
+    output_mode 见 OUTPUT_MODES，输出文件（或文件夹）的路径记录在 stats['output_path']。
+    逐个文件输出时由 writer_threads 个后台线程写盘，为0时由工作进程直接写入。
+    给出 group_column 时按该列分组，每组生成一份文档（以组内第一行命名），
+    模板表格中的重复行按组内每条记录展开，组数记录在 stats['groups']。
+    shard 为 (分片编号, 分片数) 时只生成按文件名分到本分片的文档，清单和摘要写入本分片自己的文件，
+    全部分片完成后用 merge_shard_reports 汇总。
+    template 为已加载的 CompiledTemplate 时单进程生成直接使用它，不再重新加载模板。
+    给出 template_column 时按该列为每行（分组时为每组第一行）选择模板，见 resolve_row_templates，
+    word_path 作为该列为空时的默认模板（可为 None）；每个进程最多缓存 template_pool_size 个已解析的模板，
+    模板不存在或无法读取的行记为失败。合并输出（combined）的样式、图片和页眉页脚都取自第一份文档，
+    不能与模板列同时使用。
+    compression_level（0-9，0 为不压缩，None 为默认）控制输出文档的压缩级别，store_media 为 True 时
+    图片等已压缩的媒体直接存储，prune_parts 为 True 时删除模板中的缩略图、构建基块和未使用的样式（见
+    CompiledTemplate.prune）。生成的文档总字节数和平均每份的字节数记录在 stats['bytes_written']、
+    stats['bytes_per_doc']，打包或合并输出时输出文件的大小记录在 stats['output_bytes']。
+    返回 (成功数量, 问题列表)
     """
-    # 读取数据
-    df = pd.read_excel(excel_path)
+    if template_column and output_mode == 'combined':
+        raise ValueError(COMBINED_TEMPLATE_COLUMN_ERROR)
+    stats = {} if stats is None else stats
+    metrics = metrics or MergeMetrics()
+    started = time.perf_counter()
     
-    # 读取格式信息
-    wb = openpyxl.load_workbook(excel_path, data_only=True)
-    ws = wb.active
+    name_suffix = f"_{shard[0]}-{shard[1]}" if shard else ""
+    sink = open_output_sink(output_mode, output_dir, word_path, writer_threads, name_suffix,
+                            compression_level, store_media)
+    stats['output_path'] = sink.path
+    # 每次运行都写清单，下次运行（或崩溃后重跑）可以增量生成；打包或合并输出时每次整体重新生成
+    manifest = None
+    if sink.per_file:
+        manifest = MergeManifest(output_dir, shard_file_name(".mailmerge_manifest", shard, ".jsonl") if shard else None)
+    default_path = os.path.abspath(word_path) if word_path else None
+    row_templates = None
+    if template_column:
+        row_templates = resolve_row_templates(formatted_data, template_column,
+                                              template_dir or (os.path.dirname(default_path) if default_path else None),
+                                              default_path)
+    # 每个模板只计算一次指纹；模板不存在时为 None，对应的行在下面记为失败
+    fingerprints = {}
     
-    # 获取列名
-    column_names = list(df.columns)
+    # 打包选项改变后输出的文件也不同，增量生成时不能跳过；默认选项不改变指纹，已有清单仍然有效
+    package_key = "" if (compression_level, store_media, prune_parts) == (None, False, False) else \
+        f"|{compression_level}|{store_media}|{prune_parts}"
     
-    # 存储格式化后的数据
-    formatted_data = []
+    def template_fingerprint(path):
+        if path not in fingerprints:
+            fingerprints[path] = file_fingerprint(path) + package_key if path and os.path.isfile(path) else None
+        return fingerprints[path]
+    if group_column:
+        groups = group_rows(formatted_data, group_column)
+        leaders = [rows[0] for rows in groups]
+        stats['groups'] = len(groups)
+    else:
+        groups = None
+        leaders = range(len(formatted_data))
+    # 本次（本分片）负责的 (行号, 文件名)
+    planned = []
+    tasks = []
+    row_hashes = {}
+    # 模板不可用的行：(行号, 错误)
+    unavailable = []
+    for n, i in enumerate(leaders):
+        file_name = f"{output_names[i]}.docx"
+        if shard and shard_of(file_name, shard[1]) != shard[0]:
+            continue
+        planned.append((i, file_name))
+        template_path = row_templates[i] if row_templates is not None else default_path
+        fingerprint = template_fingerprint(template_path)
+        if fingerprint is None:
+            row_hashes[i] = (file_name, None)
+            unavailable.append((i, f"模板不存在：{template_path}" if template_path else "没有指定模板"))
+            continue
+        row_data = GroupRecord([formatted_data[row] for row in groups[n]]) if groups else formatted_data[i]
+        row_hash = row_fingerprint(row_data, fingerprint) if manifest is not None else None
+        if incremental and manifest is not None and manifest.is_current(file_name, row_hash):
+            continue
+        row_hashes[i] = (file_name, row_hash)
+        # 默认模板由 _init_worker 预先加载，其余模板在工作进程中按需加载
+        tasks.append((i, row_data, sink.target(file_name), None if template_path == default_path else template_path))
+    stats['skipped'] = len(planned) - len(tasks) - len(unavailable)
+    stats['check_manifest'] = time.perf_counter() - started
     
-    # 遍历行
-    for row_idx in range(len(df)):
-        # Excel行索引从1开始，且第1行是标题
-        xl_row = row_idx + 2
-        row_data = {}
-        
-        # 遍历列
-        for col_idx, col_name in enumerate(column_names):
-            # Excel列索引从1开始
-            xl_col = col_idx + 1
-            cell = ws.cell(row=xl_row, column=xl_col)
-            
-            # 格式化单元格值
-            formatted_value = format_cell_value(cell)
-            row_data[col_name] = formatted_value
-        
-        formatted_data.append(row_data)
+    # cProfile 采样文件先写入临时目录
+    profile_dir = tempfile.mkdtemp(prefix="mailmerge_profile_") if metrics.profile_every else None
     
-    wb.close()
-    return df, formatted_data
-
-# 提取Word文档中的所有占位符
-def extract_placeholders(doc):
-    placeholder_pattern = re.compile(r'«([^»]+)»')
-    placeholders = set()
+    total = len(tasks)
+    successful_docs = 0
+    bytes_written = 0
+    issues = []
+    failures = []
+    # 已生成、等待写出的行：行号 -> 行指标
+    pending = {}
     
-    # 从段落中提取
-    for para in doc.paragraphs:
-        para_text = ''.join([run.text for run in para.runs])
-        for match in placeholder_pattern.finditer(para_text):
-            placeholders.add(match.group(1))
-    
-    # 从表格中提取
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for para in cell.paragraphs:
-                    para_text = ''.join([run.text for run in para.runs])
-                    for match in placeholder_pattern.finditer(para_text):
-                        placeholders.add(match.group(1))
-    
-    # 从页眉页脚中提取
-    for section in doc.sections:
-        for part in [section.header, section.footer]:
-            # 从段落中提取
-            for para in part.paragraphs:
-                para_text = ''.join([run.text for run in para.runs])
-                for match in placeholder_pattern.finditer(para_text):
-                    placeholders.add(match.group(1))
-            
-            # 从表格中提取
-            for table in part.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        for para in cell.paragraphs:
-                            para_text = ''.join([run.text for run in para.runs])
-                            for match in placeholder_pattern.finditer(para_text):
-                                placeholders.add(match.group(1))
+    # 一行写完（或出错）后记录结果
+    def finish_row(i, error, row_metrics):
+        nonlocal successful_docs, bytes_written
+        file_name, row_hash = row_hashes[i]
+        if error is None:
+            successful_docs += 1
+            bytes_written += row_metrics.get('bytes', 0)
+            metrics.record_row(i, row_metrics)
+            if manifest is not None:
+                manifest.record(file_name, i, row_hash)
+        else:
+            if manifest is not None:
+                manifest.discard(file_name)
+            error_msg = f"处理第 {i+1} 行数据时出错: {error}"
+            logger.error(error_msg)
+            issues.append(error_msg)
+            failures.append({'row': i + 1, 'file': file_name, 'error': error})
     
-    return placeholders
-
-# 替换模板中的字段
-def replace_placeholders(doc, replacements):
-    # 定义正则表达式模式，用于匹配占位符
-    placeholder_pattern = re.compile(r'«([^»]+)»')
-    replaced_count = 0
+    for i, error in unavailable:
+        finish_row(i, error, {})
+    
+    # 取回已写完的行
+    def collect_written():
+        for i, error, seconds in sink.completed():
+            row_metrics = pending.pop(i)
+            row_metrics['write'] = seconds
+            finish_row(i, error, row_metrics)
+    
+    started = time.perf_counter()
+    # 所有行都使用模板列中的模板时不加载默认模板
+    uses_default = any(task[3] is None for task in tasks)
+    default_template = word_path if uses_default else None
+    # 合并输出时每份文档只是中间结果，马上会被拆开，不压缩可以省下压缩和解压的时间
+    package = (0, False, prune_parts) if output_mode == 'combined' else (compression_level, store_media, prune_parts)
+    if workers <= 1:
+        if tasks:
+            # 修剪会改动模板，不能修改调用方传入的模板
+            _init_worker(default_template, use_xml_engine, metrics.profile_every, profile_dir,
+                         template if uses_default and not prune_parts else None, template_pool_size, *package)
+        stats['load_template'] = time.perf_counter() - started
+        started = time.perf_counter()
+        chunk_results = (_render_chunk([task]) for task in tasks)
+        executor = None
+    else:
+        # 分片不宜过大，以便进度能及时回报
+        chunk_size = max(1, min(50, total // (workers * 4)))
+        chunks = [tasks[start:start + chunk_size] for start in range(0, total, chunk_size)]
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(default_template, use_xml_engine, metrics.profile_every, profile_dir,
+                                                 None, template_pool_size, *package))
+        # 按提交顺序返回结果，保证进度有序；同时提交的分片有上限，写盘跟不上时不会在内存中堆积
+        chunk_results = _bounded_map(executor, _render_chunk, chunks, workers * 2)
     
+    stats['cancelled'] = False
     try:
-        # 替换段落中的占位符（更好地保留格式）
-        for para_idx, para in enumerate(doc.paragraphs):
-            # 收集所有runs的文本和长度信息
-            run_texts = [run.text for run in para.runs]
-            para_text = ''.join(run_texts)
-            
-            # 查找段落中的所有占位符
-            matches = list(placeholder_pattern.finditer(para_text))
-            
-            # 如果段落中没有占位符，则跳过
-            if not matches:
+        done = 0
+        for results in chunk_results:
+            for i, error, row_metrics, data in results:
+                done += 1
+                if data is not None:
+                    # 写出队列已满时在这里阻塞
+                    pending[i] = row_metrics
+                    sink.write(i, row_hashes[i][0], data)
+                else:
+                    finish_row(i, error, row_metrics)
+                collect_written()
+                if progress_callback:
+                    progress_callback(done, total)
+            if cancel_event is not None and cancel_event.is_set() and done < total:
+                stats['cancelled'] = True
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        _worker_state.clear()
+        try:
+            sink.close()
+            collect_written()
+        finally:
+            if manifest is not None:
+                manifest.close()
+        stats['render'] = time.perf_counter() - started
+        stats['bytes_written'] = bytes_written
+        if not sink.per_file and os.path.exists(sink.path):
+            # 打包或合并输出时按输出文件的大小平均，合并输出的中间文档不压缩，不能代表实际大小
+            stats['output_bytes'] = os.path.getsize(sink.path)
+            bytes_written = stats['output_bytes']
+        stats['bytes_per_doc'] = bytes_written // successful_docs if successful_docs else 0
+        for stage in ('check_manifest', 'load_template', 'render'):
+            if stage in stats:
+                metrics.add_stage(f"generate.{stage}", stats[stage])
+        metrics.count('skipped', stats['skipped'])
+        metrics.count('failed', len(issues))
+        if profile_dir is not None:
+            _merge_profiles(profile_dir, metrics.profile_path)
+    
+    if shard:
+        summary = {
+            'shard': list(shard),
+            'host': platform.node(),
+            'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+            'output_mode': output_mode,
+            'output_path': sink.path,
+            'total': len(leaders),
+            'planned': [[i + 1, file_name] for i, file_name in planned],
+            'successes': successful_docs,
+            'skipped': stats['skipped'],
+            'cancelled': stats['cancelled'],
+            'failures': failures,
+        }
+        with open(os.path.join(output_dir, shard_file_name(SUMMARY_PREFIX, shard, ".json")), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False)
+    
+    return successful_docs, issues
+
+# 汇总各分片的运行结果
+def merge_shard_reports(output_dir):
+    """
+    读取输出目录中各分片的摘要和清单，合并成功和失败的记录，检查缺失的分片、
+    重复或缺失的输出文件，并把各分片的清单合并为主清单（之后可以不分片增量运行）。
+    汇总报告写入 .mailmerge_summary.json 并返回，complete 为 True 表示全部文档都已生成
+    """
+    pattern = re.compile(re.escape(SUMMARY_PREFIX) + r'\.shard-(\d+)-of-(\d+)\.json$')
+    summaries = {}
+    shard_counts = set()
+    for name in os.listdir(output_dir):
+        match = pattern.match(name)
+        if match:
+            with open(os.path.join(output_dir, name), encoding='utf-8') as f:
+                summaries[int(match.group(1))] = json.load(f)
+            shard_counts.add(int(match.group(2)))
+    if not summaries:
+        raise ValueError(f"输出目录中没有分片摘要：{output_dir}")
+    if len(shard_counts) > 1:
+        raise ValueError(f"各分片的分片数不一致：{sorted(shard_counts)}")
+    totals = {summary['total'] for summary in summaries.values()}
+    if len(totals) > 1:
+        raise ValueError(f"各分片的数据行数不一致：{sorted(totals)}，请确认使用的是同一份 Excel")
+    shard_count = shard_counts.pop()
+    
+    manifest = MergeManifest(output_dir)
+    owners = {}
+    assigned_rows = set()
+    failures = []
+    duplicate_outputs = []
+    missing_outputs = []
+    for index, summary in sorted(summaries.items()):
+        failures.extend({**failure, 'shard': index} for failure in summary['failures'])
+        failed_files = {failure['file'] for failure in summary['failures']}
+        per_file = summary['output_mode'] == 'files'
+        if not per_file and not os.path.exists(summary['output_path']):
+            missing_outputs.append({'file': os.path.basename(summary['output_path']), 'shard': index})
+        shard_manifest = MergeManifest(output_dir, shard_file_name(".mailmerge_manifest", (index, shard_count), ".jsonl"))
+        for row, file_name in summary['planned']:
+            key = file_name.casefold()
+            if key in owners:
+                duplicate_outputs.append({'file': file_name, 'shards': [owners[key], index]})
+            owners[key] = index
+            assigned_rows.add(row)
+            if not per_file or file_name in failed_files:
                 continue
-                
-            # 从后向前替换，避免位置偏移问题
-            for match in reversed(matches):
-                placeholder = match.group(0)  # 完整的占位符，如 «name»
-                key = match.group(1)          # 占位符中的键，如 name
-                
-                if key in replacements:
-                    value = replacements[key]
-                    
-                    # 确定占位符在文本中的位置
-                    start_pos = match.start()
-                    end_pos = match.end()
-                    
-                    # 确定占位符跨越的runs
-                    start_run_idx = None
-                    end_run_idx = None
-                    current_pos = 0
-                    
-                    # 确定占位符开始和结束的run索引
-                    for i, run_text in enumerate(run_texts):
-                        run_len = len(run_text)
-                        if start_run_idx is None and current_pos <= start_pos < current_pos + run_len:
-                            start_run_idx = i
-                            start_run_pos = start_pos - current_pos
-                        
-                        if end_run_idx is None and current_pos < end_pos <= current_pos + run_len:
-                            end_run_idx = i
-                            end_run_pos = end_pos - current_pos
-                            break
-                        
-                        current_pos += run_len
-                    
-                    # 如果找到了占位符的位置
-                    if start_run_idx is not None and end_run_idx is not None:
-                        try:
-                            # 处理占位符在单个run中的情况
-                            if start_run_idx == end_run_idx:
-                                run = para.runs[start_run_idx]
-                                run.text = run.text[:start_run_pos] + value + run.text[end_run_pos:]
-                            else:
-                                # 处理占位符跨越多个runs的情况
-                                # 处理第一个run（保留前部分并添加替换值）
-                                first_run = para.runs[start_run_idx]
-                                first_run.text = first_run.text[:start_run_pos] + value
-                                
-                                # 处理最后一个run（只保留尾部）
-                                last_run = para.runs[end_run_idx]
-                                last_run.text = last_run.text[end_run_pos:]
-                                
-                                # 清空中间的runs
-                                for i in range(start_run_idx + 1, end_run_idx):
-                                    para.runs[i].text = ""
-                            
-                            replaced_count += 1
-                        except Exception as e:
-                            logger.error(f"替换段落#{para_idx}中的'{placeholder}'时出错: {e}")
-        
-        # 替换表格中的占位符
-        for table_idx, table in enumerate(doc.tables):
-            for row_idx, row in enumerate(table.rows):
-                for cell_idx, cell in enumerate(row.cells):
-                    for para_idx, paragraph in enumerate(cell.paragraphs):
-                        # 收集所有runs的文本和长度信息
-                        if len(paragraph.runs) == 0:
-                            continue
-                            
-                        run_texts = [run.text for run in paragraph.runs]
-                        para_text = ''.join(run_texts)
-                        
-                        # 查找段落中的所有占位符
-                        matches = list(placeholder_pattern.finditer(para_text))
-                        
-                        # 如果段落中没有占位符，则跳过
-                        if not matches:
-                            continue
-                            
-                        # 从后向前替换，避免位置偏移问题
-                        for match in reversed(matches):
-                            placeholder = match.group(0)  # 完整的占位符，如 «name»
-                            key = match.group(1)          # 占位符中的键，如 name
-                            
-                            if key in replacements:
-                                value = replacements[key]
-                                
-                                # 确定占位符在文本中的位置
-                                start_pos = match.start()
-                                end_pos = match.end()
-                                
-                                # 确定占位符跨越的runs
-                                start_run_idx = None
-                                end_run_idx = None
-                                current_pos = 0
-                                
-                                # 确定占位符开始和结束的run索引
-                                for i, run_text in enumerate(run_texts):
-                                    run_len = len(run_text)
-                                    if start_run_idx is None and current_pos <= start_pos < current_pos + run_len:
-                                        start_run_idx = i
-                                        start_run_pos = start_pos - current_pos
-                                    
-                                    if end_run_idx is None and current_pos < end_pos <= current_pos + run_len:
-                                        end_run_idx = i
-                                        end_run_pos = end_pos - current_pos
-                                        break
-                                    
-                                    current_pos += run_len
-                                
-                                # 如果找到了占位符的位置
-                                if start_run_idx is not None and end_run_idx is not None:
-                                    try:
-                                        # 处理占位符在单个run中的情况
-                                        if start_run_idx == end_run_idx:
-                                            run = paragraph.runs[start_run_idx]
-                                            run.text = run.text[:start_run_pos] + value + run.text[end_run_pos:]
-                                        else:
-                                            # 处理占位符跨越多个runs的情况
-                                            # 处理第一个run（保留前部分并添加替换值）
-                                            first_run = paragraph.runs[start_run_idx]
-                                            first_run.text = first_run.text[:start_run_pos] + value
-                                            
-                                            # 处理最后一个run（只保留尾部）
-                                            last_run = paragraph.runs[end_run_idx]
-                                            last_run.text = last_run.text[end_run_pos:]
-                                            
-                                            # 清空中间的runs
-                                            for i in range(start_run_idx + 1, end_run_idx):
-                                                paragraph.runs[i].text = ""
-                                        
-                                        replaced_count += 1
-                                    except Exception as e:
-                                        logger.error(f"替换表格#{table_idx}的单元格[{row_idx},{cell_idx}]段落#{para_idx}中的'{placeholder}'时出错: {e}")
-        
-        # 替换页眉和页脚中的占位符
-        for section_idx, section in enumerate(doc.sections):
-            # 处理页眉和页脚
-            try:
-                for part_name, part in [('header', section.header), ('footer', section.footer)]:
-                    for para_idx, para in enumerate(part.paragraphs):
-                        # 收集所有runs的文本
-                        if len(para.runs) == 0:
-                            continue
-                            
-                        run_texts = [run.text for run in para.runs]
-                        para_text = ''.join(run_texts)
-                        
-                        # 查找段落中的所有占位符
-                        matches = list(placeholder_pattern.finditer(para_text))
-                        
-                        # 如果段落中没有占位符，则跳过
-                        if not matches:
-                            continue
-                            
-                        # 从后向前替换，避免位置偏移问题
-                        for match in reversed(matches):
-                            placeholder = match.group(0)  # 完整的占位符，如 «name»
-                            key = match.group(1)          # 占位符中的键，如 name
-                            
-                            if key in replacements:
-                                value = replacements[key]
-                                
-                                # 确定占位符在文本中的位置
-                                start_pos = match.start()
-                                end_pos = match.end()
-                                
-                                # 确定占位符跨越的runs
-                                start_run_idx = None
-                                end_run_idx = None
-                                current_pos = 0
-                                
-                                # 确定占位符开始和结束的run索引
-                                for i, run_text in enumerate(run_texts):
-                                    run_len = len(run_text)
-                                    if start_run_idx is None and current_pos <= start_pos < current_pos + run_len:
-                                        start_run_idx = i
-                                        start_run_pos = start_pos - current_pos
-                                    
-                                    if end_run_idx is None and current_pos < end_pos <= current_pos + run_len:
-                                        end_run_idx = i
-                                        end_run_pos = end_pos - current_pos
-                                        break
-                                    
-                                    current_pos += run_len
-                                
-                                # 如果找到了占位符的位置
-                                if start_run_idx is not None and end_run_idx is not None:
-                                    try:
-                                        # 处理占位符在单个run中的情况
-                                        if start_run_idx == end_run_idx:
-                                            run = para.runs[start_run_idx]
-                                            run.text = run.text[:start_run_pos] + value + run.text[end_run_pos:]
-                                        else:
-                                            # 处理占位符跨越多个runs的情况
-                                            # 处理第一个run（保留前部分并添加替换值）
-                                            first_run = para.runs[start_run_idx]
-                                            first_run.text = first_run.text[:start_run_pos] + value
-                                            
-                                            # 处理最后一个run（只保留尾部）
-                                            last_run = para.runs[end_run_idx]
-                                            last_run.text = last_run.text[end_run_pos:]
-                                            
-                                            # 清空中间的runs
-                                            for i in range(start_run_idx + 1, end_run_idx):
-                                                para.runs[i].text = ""
-                                        
-                                        replaced_count += 1
-                                    except Exception as e:
-                                        logger.error(f"替换章节#{section_idx}的{part_name}段落#{para_idx}中的'{placeholder}'时出错: {e}")
-            except Exception as e:
-                logger.error(f"处理章节#{section_idx}的页眉或页脚时出错: {e}")
-                        
-        return replaced_count
-    except Exception as e:
-        logger.error(f"替换文档模板时发生错误: {e}")
-        return 0
+            entry = shard_manifest.entries.get(file_name)
+            if entry is None or not os.path.exists(os.path.join(output_dir, file_name)):
+                missing_outputs.append({'row': row, 'file': file_name, 'shard': index})
+            else:
+                manifest.entries[file_name] = entry
+    manifest.close()
+    
+    report = {
+        'shards': shard_count,
+        'missing_shards': [index for index in range(1, shard_count + 1) if index not in summaries],
+        'cancelled_shards': [index for index, summary in sorted(summaries.items()) if summary['cancelled']],
+        'hosts': {index: summary['host'] for index, summary in sorted(summaries.items())},
+        'total': totals.pop(),
+        'assigned': len(assigned_rows),
+        'successes': sum(summary['successes'] for summary in summaries.values()),
+        'skipped': sum(summary['skipped'] for summary in summaries.values()),
+        'failures': failures,
+        'duplicate_outputs': duplicate_outputs,
+        'missing_outputs': missing_outputs,
+    }
+    report['complete'] = (report['assigned'] == report['total'] and not failures and not duplicate_outputs
+                          and not missing_outputs and not report['missing_shards'] and not report['cancelled_shards'])
+    with open(os.path.join(output_dir, SUMMARY_PREFIX + ".json"), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+# Windows 路径长度上限（不含结尾的空字符）
+MAX_PATH_LENGTH = 259
+
+# Windows 保留的设备文件名
+RESERVED_FILENAMES = {'CON', 'PRN', 'AUX', 'NUL'} | {f"{prefix}{n}" for prefix in ('COM', 'LPT') for n in range(1, 10)}
+
+# 取出一列的所有值
+def column_values(formatted_data, column):
+    if isinstance(formatted_data, FormattedRows):
+        return formatted_data.column(column)
+    return [row_data[column] for row_data in formatted_data]
+
+# 生成前的预检（试运行）
+def validate_rows(columns, formatted_data, placeholders, filename_column, output_dir, sample_size=5,
+                  group_column=None, row_templates=None):
+    """
+    不渲染任何文档，按列一次性检查所有行：占位符与列的映射、每个占位符的空值、
+    文件名冲突（按 Windows 规则不区分大小写）、保留文件名和过长路径。
+    给出 group_column 时每组只检查第一行的文件名。
+    按行选择模板时传入 resolve_row_templates 的结果，逐个模板检查映射，结果记录在 templates 中。
+    返回检查报告字典，problems 为问题总数
+    """
+    column_set = set(columns)
+    placeholders = {placeholder_column(field) for field in placeholders}
+    unmapped_fields = sorted(field for field in placeholders if field not in column_set)
+    templates = None
+    if row_templates is not None:
+        # 各模板缺少的列单独报告，空值和未使用列按所有模板的占位符检查
+        templates = check_template_mapping(columns, row_templates)
+        for result in templates.values():
+            placeholders.update(placeholder_column(field) for field in result.get('placeholders', ()))
+    report = {
+        'rows': len(formatted_data),
+        'unmapped_fields': unmapped_fields,
+        'unused_columns': [column for column in columns if column not in placeholders],
+        'empty_values': {},
+        'filename_collisions': {},
+        'reserved_filenames': [],
+        'long_paths': [],
+    }
+    
+    # 每个占位符的空值（按列一次性检查）
+    for field in sorted(placeholders & column_set):
+        empty_rows = [i + 1 for i, value in enumerate(column_values(formatted_data, field))
+                      if not str(value).strip()]
+        if empty_rows:
+            report['empty_values'][field] = {'count': len(empty_rows), 'rows': empty_rows[:sample_size]}
+    
+    # 文件名冲突、保留文件名、路径长度
+    if filename_column in column_set:
+        output_dir = os.path.abspath(output_dir)
+        values = column_values(formatted_data, filename_column)
+        if group_column in column_set:
+            # 分组时每组只生成一份文档，以组内第一行命名
+            named_rows = [group[0] for group in group_rows(formatted_data, group_column)]
+        else:
+            named_rows = range(len(values))
+        names = {i: make_safe_filename(values[i], i) for i in named_rows}
+        rows_by_name = collections.defaultdict(list)
+        for i, name in names.items():
+            # Windows 文件名不区分大小写，并忽略结尾的点和空格
+            rows_by_name[name.rstrip(' .').casefold()].append(i + 1)
+        report['filename_collisions'] = {
+            f"{names[rows[0] - 1]}.docx": rows for rows in rows_by_name.values() if len(rows) > 1
+        }
+        report['reserved_filenames'] = [
+            {'row': i + 1, 'file': f"{name}.docx"} for i, name in names.items()
+            if name.split('.')[0].upper() in RESERVED_FILENAMES
+        ][:sample_size]
+        dir_length = len(output_dir) + 1
+        long_rows = [i for i, name in names.items() if dir_length + len(name) + len(".docx") > MAX_PATH_LENGTH]
+        report['long_paths'] = [
+            {'row': i + 1, 'length': dir_length + len(names[i]) + len(".docx")} for i in long_rows[:sample_size]
+        ]
+        report['long_path_count'] = len(long_rows)
+    else:
+        report['unmapped_filename_column'] = filename_column
+    if group_column and group_column not in column_set:
+        report['unmapped_group_column'] = group_column
+    if templates is not None:
+        report['templates'] = {path or "": {key: value for key, value in result.items() if key != 'placeholders'}
+                               for path, result in templates.items()}
+    
+    report['problems'] = (len(report['unmapped_fields']) + len(report['empty_values'])
+                          + len(report['filename_collisions']) + len(report['reserved_filenames'])
+                          + report.get('long_path_count', 0) + (1 if 'unmapped_filename_column' in report else 0)
+                          + (1 if 'unmapped_group_column' in report else 0)
+                          + sum(len(result.get('missing_fields', ())) + (1 if 'error' in result else 0)
+                                for result in report.get('templates', {}).values()))
+    return report
+
+# 把预检报告转换为可读文本
+def format_validation_report(report):
+    lines = [f"=== 预检（试运行）：共 {report['rows']} 行 ==="]
+    if 'unmapped_filename_column' in report:
+        lines.append(f"❌ 命名列不存在：{report['unmapped_filename_column']}")
+    if 'unmapped_group_column' in report:
+        lines.append(f"❌ 分组列不存在：{report['unmapped_group_column']}")
+    if report['unmapped_fields']:
+        lines.append(f"⚠️ {len(report['unmapped_fields'])} 个占位符在 Excel 中没有对应列：" +
+                     "、".join(f"«{field}»" for field in report['unmapped_fields']))
+    for path, result in report.get('templates', {}).items():
+        name = os.path.basename(path) if path else "（未指定模板）"
+        if 'error' in result:
+            lines.append(f"❌ 模板 {name}（{result['rows']} 行）：{result['error']}")
+        elif result['missing_fields']:
+            lines.append(f"⚠️ 模板 {name}（{result['rows']} 行）有 {len(result['missing_fields'])} 个占位符没有对应列：" +
+                         "、".join(f"«{field}»" for field in result['missing_fields']))
+        else:
+            lines.append(f"✅ 模板 {name}（{result['rows']} 行）的占位符都有对应列")
+    for field, empty in report['empty_values'].items():
+        rows = "、".join(str(row) for row in empty['rows'])
+        lines.append(f"⚠️ «{field}» 有 {empty['count']} 行为空（如第 {rows} 行）")
+    for file_name, rows in report['filename_collisions'].items():
+        lines.append(f"❌ 文件名冲突 {file_name}：第 {'、'.join(str(row) for row in rows[:10])} 行会互相覆盖")
+    for item in report['reserved_filenames']:
+        lines.append(f"❌ 第 {item['row']} 行的文件名 {item['file']} 是 Windows 保留名称")
+    if report.get('long_path_count'):
+        example = report['long_paths'][0]
+        lines.append(f"❌ {report['long_path_count']} 个输出路径超过 {MAX_PATH_LENGTH} 个字符"
+                     f"（如第 {example['row']} 行，长度 {example['length']}）")
+    if report['unused_columns']:
+        lines.append(f"ℹ️ Excel 中有 {len(report['unused_columns'])} 个列在模板中未使用")
+    if not report['problems']:
+        lines.append("✅ 预检通过，没有发现问题")
+    return lines
+
+# 格式化剩余时间
+def format_duration(seconds):
+    seconds = int(seconds + 0.5)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
 
 # 主界面类
 class MailMergeApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Excel-Word 邮件合并工具")
-        self.root.geometry("700x650")
+        self.root.geometry("700x1010")
 
         self.excel_path = ""
         self.word_path = ""
+        self.template_dir = ""
         self.output_dir = ""
-        self.df = None
+        self.columns = None
         self.formatted_data = None
         self.template_placeholders = set()  # 存储模板中的占位符
+        self.progress_queue = queue.Queue()  # 后台生成线程发给界面的消息
+        self.cancel_event = threading.Event()
+        # 预览用的已解析模板，模板文件修改后自动重新加载
+        self.preview_templates = FileLRUCache(CompiledTemplate.load, 8)
 
         # Excel 文件选择
-        tk.Label(root, text="① 请选择 Excel 文件：").pack(pady=5)
+        tk.Label(root, text="① 请选择 Excel 文件（也支持 CSV、SQLite）：").pack(pady=5)
         tk.Button(root, text="选择 Excel", command=self.select_excel).pack()
 
         # Word 模板选择
@@ -438,67 +2525,167 @@ class MailMergeApp:
         self.filename_column = ttk.Combobox(root, state="readonly")
         self.filename_column.pack()
 
+        # 分组列选择：同一分组的多行合并为一份文档，模板表格中含 «@列名» 的行按组内每行重复
+        tk.Label(root, text="分组列（可选，同组多行生成一份文档）：").pack()
+        self.group_column = ttk.Combobox(root, state="readonly")
+        self.group_column.pack()
+
+        # 模板列选择：每行按该列的值选择模板，为空的行使用上面选择的 Word 模板
+        tk.Label(root, text="模板列（可选，按行选择模板）：").pack()
+        self.template_column = ttk.Combobox(root, state="readonly")
+        self.template_column.pack()
+        tk.Button(root, text="选择模板文件夹", command=self.select_template_dir).pack()
+
         # 输出路径选择
         tk.Label(root, text="④ 选择输出文件夹（可选）：").pack(pady=5)
         tk.Button(root, text="选择输出文件夹", command=self.select_output_dir).pack()
         self.output_dir_label = tk.Label(root, text="默认使用 Excel 同目录的 output_docs 文件夹")
         self.output_dir_label.pack()
 
+        # 渲染引擎选择
+        self.use_xml_engine = tk.BooleanVar(value=False)
+        tk.Checkbutton(root, text="使用XML快速引擎（只重写含占位符的部件）", variable=self.use_xml_engine).pack()
+
+        # 增量生成
+        self.incremental = tk.BooleanVar(value=False)
+        tk.Checkbutton(root, text="增量生成（跳过内容未变化且文件已存在的行，可从中断处继续）", variable=self.incremental).pack()
+
+        # 输出方式
+        tk.Label(root, text="输出方式：").pack()
+        self.output_mode = ttk.Combobox(root, state="readonly", values=list(OUTPUT_MODES.values()), width=36)
+        self.output_mode.current(0)
+        self.output_mode.pack()
+
+        # 输出文档的大小：压缩级别越高文件越小、生成越慢
+        tk.Label(root, text="压缩级别（0 不压缩，9 最小）：").pack()
+        self.compression_level = ttk.Combobox(root, state="readonly", values=["默认"] + [str(n) for n in range(10)], width=8)
+        self.compression_level.current(0)
+        self.compression_level.pack()
+        self.store_media = tk.BooleanVar(value=False)
+        tk.Checkbutton(root, text="图片等已压缩的媒体直接存储（不再压缩）", variable=self.store_media).pack()
+        self.prune_parts = tk.BooleanVar(value=False)
+        tk.Checkbutton(root, text="删除模板中未使用的样式、缩略图和构建基块", variable=self.prune_parts).pack()
+
+        # 并行进程数
+        tk.Label(root, text="并行进程数：").pack()
+        self.worker_count = tk.IntVar(value=1)
+        tk.Spinbox(root, from_=1, to=os.cpu_count() or 1, textvariable=self.worker_count, width=5).pack()
+
         # 字段映射检查按钮
         tk.Button(root, text="⤷ 检查字段映射", command=self.check_field_mapping).pack(pady=5)
+        tk.Button(root, text="⤷ 预检全部数据（试运行，不生成文档）",
+                  command=lambda: self.check_field_mapping(dry_run=True)).pack()
+        tk.Button(root, text="⤷ 预览替换结果（逐份查看，不生成文档）", command=self.open_preview).pack(pady=5)
 
         # 合并执行按钮
-        tk.Button(root, text="⑤ 开始合并生成文档", command=self.generate_docs, bg="green", fg="white").pack(pady=20)
+        self.generate_button = tk.Button(root, text="⑤ 开始合并生成文档", command=self.generate_docs, bg="green", fg="white")
+        self.generate_button.pack(pady=(20, 5))
+
+        # 进度条、速度和取消按钮
+        self.progress = ttk.Progressbar(root, length=500, mode="determinate")
+        self.progress.pack()
+        self.progress_label = tk.Label(root, text="")
+        self.progress_label.pack()
+        self.cancel_button = tk.Button(root, text="取消", command=self.cancel_generation, state=tk.DISABLED)
+        self.cancel_button.pack(pady=5)
 
         # 状态输出框
         self.status = tk.Text(root, height=10, width=120)
         self.status.pack()
 
     def select_excel(self):
-        self.excel_path = filedialog.askopenfilename(filetypes=[("Excel files", "*.xlsx *.xls")])
+        self.excel_path = filedialog.askopenfilename(filetypes=[
+            ("数据文件", "*.xlsx *.xls *.csv *.db *.sqlite *.sqlite3"),
+            ("Excel files", "*.xlsx *.xls"), ("CSV files", "*.csv"), ("SQLite files", "*.db *.sqlite *.sqlite3")])
         if self.excel_path:
             try:
-                # 读取Excel数据和格式信息
-                self.df, self.formatted_data = read_excel_with_format(self.excel_path)
-                self.status.insert(tk.END, f"✅ 已加载 Excel 文件：{self.excel_path}\n")
-                self.status.insert(tk.END, f"   共 {len(self.df.columns)} 列, {len(self.df)} 行数据\n")
-                self.filename_column['values'] = list(self.df.columns)
-                if len(self.df.columns) > 0:
+                query = None
+                if SOURCE_EXTENSIONS.get(os.path.splitext(self.excel_path)[1].lower()) is SqliteSource:
+                    query = simpledialog.askstring("SQL 查询", "请输入读取数据的查询语句：", initialvalue="SELECT * FROM ")
+                    if not query:
+                        return
+                # 读取数据和格式信息
+                self.columns, self.formatted_data = open_row_source(self.excel_path, query).load()
+                self.status.insert(tk.END, f"✅ 已加载数据文件：{self.excel_path}\n")
+                self.status.insert(tk.END, f"   共 {len(self.columns)} 列, {len(self.formatted_data)} 行数据\n")
+                self.filename_column['values'] = self.columns
+                if len(self.columns) > 0:
                     self.filename_column.current(0)
+                self.group_column['values'] = [""] + list(self.columns)
+                self.group_column.current(0)
+                self.template_column['values'] = [""] + list(self.columns)
+                self.template_column.current(0)
                 
                 # 如果已经选择了Word模板，检查字段映射
                 if hasattr(self, 'template_placeholders') and self.template_placeholders:
                     self.check_field_mapping()
             except Exception as e:
-                messagebox.showerror("错误", f"无法读取 Excel 文件：{e}")
+                messagebox.showerror("错误", f"无法读取数据文件：{e}")
                 logger.error(f"读取Excel文件出错: {e}")
 
     def select_word(self):
         self.word_path = filedialog.askopenfilename(filetypes=[("Word files", "*.docx")])
         if self.word_path:
             try:
-                doc = Document(self.word_path)
-                self.template_placeholders = extract_placeholders(doc)
+                # 模板未变化时直接使用磁盘缓存的分析结果
+                self.template_placeholders = template_cache.placeholders(self.word_path)
                 placeholder_count = len(self.template_placeholders)
                 self.status.insert(tk.END, f"✅ 已选择 Word 模板文件：{self.word_path}，包含 {placeholder_count} 个不同占位符\n")
                 
                 # 如果已经选择了Excel文件，检查字段映射
-                if self.df is not None:
+                if self.columns is not None:
                     self.check_field_mapping()
             except Exception as e:
                 messagebox.showerror("错误", f"无法读取 Word 模板：{e}")
 
+    def select_template_dir(self):
+        self.template_dir = filedialog.askdirectory()
+        if self.template_dir:
+            self.status.insert(tk.END, f"📁 模板文件夹：{self.template_dir}\n")
+
+    # 模板列中文件名所在的文件夹：未选择时使用 Word 模板或 Excel 所在文件夹
+    def resolve_row_templates(self):
+        template_dir = self.template_dir or os.path.dirname(self.word_path or self.excel_path)
+        return resolve_row_templates(self.formatted_data, self.template_column.get(), template_dir,
+                                     self.word_path or None)
+
+    def check_template_mapping(self, dry_run=False):
+        results = check_template_mapping(self.columns, self.resolve_row_templates())
+        self.status.insert(tk.END, f"\n=== 字段映射检查（按模板列，共 {len(results)} 个模板）===\n")
+        problems = 0
+        for path, result in results.items():
+            name = os.path.basename(path) if path else "（未指定模板）"
+            if 'error' in result:
+                problems += 1
+                self.status.insert(tk.END, f"❌ {name}（{result['rows']} 行）：{result['error']}\n")
+            elif result['missing_fields']:
+                problems += 1
+                self.status.insert(tk.END, f"⚠️ {name}（{result['rows']} 行）有 {len(result['missing_fields'])} 个占位符没有对应列："
+                                           + "、".join(f"«{field}»" for field in result['missing_fields']) + "\n")
+            else:
+                self.status.insert(tk.END, f"✅ {name}（{result['rows']} 行）的占位符都有对应列\n")
+        self.status.see(tk.END)
+        if dry_run:
+            self.run_dry_run()
+        elif problems:
+            messagebox.showwarning("字段映射警告", f"{problems} 个模板不存在或有占位符没有对应列，详情请查看状态窗口。")
+        else:
+            messagebox.showinfo("字段映射正确", "所有模板的占位符在 Excel 中都有对应列！")
+
     def select_output_dir(self):
         self.output_dir = filedialog.askdirectory()
         if self.output_dir:
             self.output_dir_label.config(text=f"📁 输出目录：{self.output_dir}")
 
-    def check_field_mapping(self):
+    def check_field_mapping(self, dry_run=False):
+        if self.columns is not None and self.template_column.get():
+            self.check_template_mapping(dry_run)
+            return
+        
         if not hasattr(self, 'template_placeholders') or not self.template_placeholders:
             if self.word_path:
                 try:
-                    doc = Document(self.word_path)
-                    self.template_placeholders = extract_placeholders(doc)
+                    self.template_placeholders = template_cache.placeholders(self.word_path)
                 except Exception as e:
                     messagebox.showerror("错误", f"无法读取 Word 模板：{e}")
                     return
@@ -506,13 +2693,14 @@ class MailMergeApp:
                 messagebox.showwarning("警告", "请先选择 Word 模板文件！")
                 return
         
-        if self.df is None:
+        if self.columns is None:
             messagebox.showwarning("警告", "请先选择 Excel 文件！")
             return
         
         # 检查字段映射
-        excel_columns = set(self.df.columns)
-        missing_fields = [field for field in self.template_placeholders if field not in excel_columns]
+        excel_columns = set(self.columns)
+        # «@列名» 是重复行占位符，对应的列名不含前缀
+        missing_fields = [field for field in self.template_placeholders if placeholder_column(field) not in excel_columns]
         
         self.status.insert(tk.END, "\n=== 字段映射检查 ===\n")
         
@@ -521,21 +2709,60 @@ class MailMergeApp:
             for field in missing_fields:
                 self.status.insert(tk.END, f"  - «{field}»\n")
             
-            messagebox.showwarning("字段映射警告", 
-                                  f"发现 {len(missing_fields)} 个模板占位符在 Excel 中没有对应列。\n"
-                                  f"这些占位符在生成文档时将保持不变。\n"
-                                  f"详情请查看状态窗口。")
+            if not dry_run:
+                messagebox.showwarning("字段映射警告", 
+                                      f"发现 {len(missing_fields)} 个模板占位符在 Excel 中没有对应列。\n"
+                                      f"这些占位符在生成文档时将保持不变。\n"
+                                      f"详情请查看状态窗口。")
         else:
             self.status.insert(tk.END, "✅ 所有占位符在 Excel 中都有对应列！\n")
-            messagebox.showinfo("字段映射正确", "所有占位符在 Excel 中都有对应列！")
+            if not dry_run:
+                messagebox.showinfo("字段映射正确", "所有占位符在 Excel 中都有对应列！")
         
-        unused_columns = [col for col in excel_columns if col not in self.template_placeholders]
+        used_columns = {placeholder_column(field) for field in self.template_placeholders}
+        unused_columns = [col for col in excel_columns if col not in used_columns]
         if unused_columns:
             self.status.insert(tk.END, f"ℹ️ Excel 中有 {len(unused_columns)} 个列在模板中未使用\n")
+        
+        if dry_run:
+            self.run_dry_run()
+
+    def open_preview(self):
+        if self.columns is None:
+            messagebox.showwarning("警告", "请先选择 Excel 文件！")
+            return
+        if not (self.word_path or self.template_column.get()):
+            messagebox.showwarning("警告", "请先选择 Word 模板文件（或模板列）！")
+            return
+        if not len(self.formatted_data):
+            messagebox.showwarning("警告", "Excel 中没有数据行！")
+            return
+        PreviewWindow(self)
+
+    def run_dry_run(self):
+        selected_column = self.filename_column.get()
+        output_dir = self.output_dir or os.path.join(os.path.dirname(self.excel_path), "output_docs")
+        started = time.perf_counter()
+        row_templates = self.resolve_row_templates() if self.template_column.get() else None
+        placeholders = self.template_placeholders if self.word_path else set()
+        report = validate_rows(self.columns, self.formatted_data, placeholders, selected_column, output_dir,
+                               group_column=self.group_column.get() or None, row_templates=row_templates)
+        elapsed = time.perf_counter() - started
+        
+        self.status.insert(tk.END, "\n")
+        for line in format_validation_report(report):
+            self.status.insert(tk.END, line + "\n")
+        self.status.insert(tk.END, f"   预检耗时 {elapsed:.3f} 秒\n")
+        self.status.see(tk.END)
+        
+        if report['problems']:
+            messagebox.showwarning("预检发现问题", f"预检发现 {report['problems']} 个问题，详情请查看状态窗口。")
+        else:
+            messagebox.showinfo("预检通过", f"全部 {report['rows']} 行数据预检通过！")
 
     def generate_docs(self):
-        if self.df is None or self.formatted_data is None or not self.word_path:
-            messagebox.showwarning("警告", "请确保已选择 Excel 和 Word 模板！")
+        if self.columns is None or self.formatted_data is None or not (self.word_path or self.template_column.get()):
+            messagebox.showwarning("警告", "请确保已选择 Excel 和 Word 模板（或模板列）！")
             return
 
         selected_column = self.filename_column.get()
@@ -543,80 +2770,601 @@ class MailMergeApp:
             messagebox.showwarning("警告", "请先选择用于命名文档的 Excel 列名！")
             return
 
+        if self.template_column.get() and list(OUTPUT_MODES)[self.output_mode.current()] == 'combined':
+            messagebox.showwarning("警告", COMBINED_TEMPLATE_COLUMN_ERROR)
+            return
+
         try:
             # 使用用户选择的输出路径或默认路径
             output_dir = self.output_dir or os.path.join(os.path.dirname(self.excel_path), "output_docs")
             os.makedirs(output_dir, exist_ok=True)
             
-            successful_docs = 0
-            issues = []
-            
             # 显示进度信息
-            self.status.insert(tk.END, f"⏳ 开始处理 {len(self.df)} 份文档...\n")
-            self.root.update()
-
-            # 获取Excel工作簿以读取原始格式
-            wb = openpyxl.load_workbook(self.excel_path, data_only=True)
-            ws = wb.active
-            
-            # 获取命名列的索引
-            column_names = list(self.df.columns)
-            filename_col_idx = column_names.index(selected_column)
-
-            for i, row_data in enumerate(self.formatted_data):
-                try:
-                    doc = Document(self.word_path)
-                    replaced = replace_placeholders(doc, row_data)
-
-                    # 获取用于命名的单元格（Excel行从2开始，因为第1行是标题）
-                    excel_row = i + 2
-                    excel_col = filename_col_idx + 1  # Excel列从1开始
-                    naming_cell = ws.cell(row=excel_row, column=excel_col)
-                    
-                    # 使用格式化后的单元格值作为文件名，保持格式
-                    name_formatted = format_cell_value(naming_cell)
-                    
-                    # 确保文件名安全
-                    name_str = str(name_formatted).strip().replace("/", "_").replace("\\", "_").replace(":", "_").replace("*", "_").replace("?", "_").replace("\"", "_").replace("<", "_").replace(">", "_").replace("|", "_")
-                    
-                    # 如果文件名为空，使用默认名称
-                    if not name_str or name_str.isspace():
-                        name_str = f"document_{i+1}"
-                    
-                    output_path = os.path.join(output_dir, f"{name_str}.docx")
-                    doc.save(output_path)
-                    
-                    successful_docs += 1
-                    
-                    # 每10个文档更新一次状态
-                    if i % 10 == 0 or i == len(self.df) - 1:
-                        self.status.insert(tk.END, f"✓ 已生成 {i+1}/{len(self.df)} 份文档\n")
-                        self.root.update()
-                        
-                except Exception as e:
-                    error_msg = f"处理第 {i+1} 行数据时出错: {e}"
-                    logger.error(error_msg)
-                    issues.append(error_msg)
-            
-            # 关闭工作簿
-            wb.close()
-
-            self.status.insert(tk.END, f"🎉 成功生成 {successful_docs} 份文档，保存在：{output_dir}\n")
-            
-            if issues:
-                self.status.insert(tk.END, f"⚠️ 处理过程中有 {len(issues)} 个问题\n")
-                messagebox.showinfo("完成", f"成功生成 {successful_docs} 份文档，有 {len(issues)} 个问题。请查看日志了解详情。")
+            if self.group_column.get():
+                self.status.insert(tk.END, f"⏳ 开始处理 {len(self.formatted_data)} 行数据，按「{self.group_column.get()}」分组"
+                                           f"（{self.worker_count.get()} 个进程）...\n")
             else:
-                messagebox.showinfo("完成", f"成功生成 {successful_docs} 份文档！")
+                self.status.insert(tk.END, f"⏳ 开始处理 {len(self.formatted_data)} 份文档（{self.worker_count.get()} 个进程）...\n")
+
+            # 使用格式化后的命名列作为文件名，保持格式（如前导零）
+            output_names = [
+                make_safe_filename(value, i)
+                for i, value in enumerate(column_values(self.formatted_data, selected_column))
+            ]
         except Exception as e:
             error_msg = f"生成文档过程中发生错误: {e}"
             self.status.insert(tk.END, f"❌ {error_msg}\n")
             logger.error(error_msg)
             messagebox.showerror("错误", str(e))
+            return
 
+        # 在后台线程中生成，界面通过 after() 轮询进度队列
+        self.cancel_event.clear()
+        self.generate_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress.config(maximum=max(len(output_names), 1), value=0)
+        self.progress_label.config(text="")
+        self.generation_started = time.perf_counter()
+        options = dict(
+            workers=self.worker_count.get(),
+            use_xml_engine=self.use_xml_engine.get(),
+            incremental=self.incremental.get(),
+            output_mode=list(OUTPUT_MODES)[self.output_mode.current()],
+            group_column=self.group_column.get() or None,
+            template_column=self.template_column.get() or None,
+            template_dir=self.template_dir or os.path.dirname(self.word_path or self.excel_path),
+            compression_level=None if self.compression_level.current() == 0 else self.compression_level.current() - 1,
+            store_media=self.store_media.get(),
+            prune_parts=self.prune_parts.get(),
+        )
+        worker = threading.Thread(
+            target=self._generation_worker,
+            args=(self.word_path or None, self.formatted_data, output_names, output_dir, options),
+            daemon=True)
+        worker.start()
+        self.root.after(100, self.poll_progress)
 
-# 启动界面
-if __name__ == "__main__":
+    def _generation_worker(self, word_path, formatted_data, output_names, output_dir, options):
+        # 后台线程不能直接操作界面，只向队列发送消息
+        try:
+            stats = {}
+            metrics = MergeMetrics()
+            successful_docs, issues = generate_documents(
+                word_path, formatted_data, output_names, output_dir,
+                progress_callback=lambda done, total: self.progress_queue.put(('progress', done, total)),
+                stats=stats, cancel_event=self.cancel_event, metrics=metrics, **options)
+            # 详细指标写入输出目录，便于分析慢在哪个阶段
+            metrics.export(os.path.join(output_dir, ".mailmerge_metrics.json"))
+            stats['metrics'] = metrics.summary()
+            self.progress_queue.put(('done', successful_docs, issues, output_dir, stats))
+        except Exception as e:
+            self.progress_queue.put(('error', e))
+
+    def cancel_generation(self):
+        self.cancel_event.set()
+        self.cancel_button.config(state=tk.DISABLED)
+        self.status.insert(tk.END, "⏹ 正在取消，当前文档完成后停止...\n")
+
+    def poll_progress(self):
+        finished = False
+        try:
+            while True:
+                message = self.progress_queue.get_nowait()
+                if message[0] == 'progress':
+                    self.show_progress(*message[1:])
+                else:
+                    finished = True
+                    self.finish_generation(message)
+        except queue.Empty:
+            pass
+        if not finished:
+            self.root.after(100, self.poll_progress)
+
+    def show_progress(self, done, total):
+        # 分组或增量生成时实际份数少于行数
+        self.progress.config(maximum=max(total, 1), value=done)
+        elapsed = time.perf_counter() - self.generation_started
+        rate = done / elapsed if elapsed > 0 else 0
+        eta = format_duration((total - done) / rate) if rate > 0 else "--:--"
+        self.progress_label.config(text=f"{done}/{total}    {rate:.1f} 份/秒    预计剩余 {eta}")
+        # 每10个文档更新一次状态
+        if done % 10 == 1 or done == total:
+            self.status.insert(tk.END, f"✓ 已生成 {done}/{total} 份文档\n")
+
+    def finish_generation(self, message):
+        self.generate_button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        
+        if message[0] == 'error':
+            error_msg = f"生成文档过程中发生错误: {message[1]}"
+            self.status.insert(tk.END, f"❌ {error_msg}\n")
+            logger.error(error_msg)
+            messagebox.showerror("错误", str(message[1]))
+            return
+        
+        _, successful_docs, issues, output_dir, stats = message
+        cancelled = stats['cancelled']
+        output_path = stats.get('output_path', output_dir)
+        if stats['skipped']:
+            self.status.insert(tk.END, f"⏭ 跳过 {stats['skipped']} 份内容未变化的文档\n")
+        stage_seconds = {name: total['seconds'] for name, total in stats['metrics']['stages'].items()}
+        if stage_seconds:
+            stage_names = {'row.clone': '复制模板', 'row.replace': '替换占位符', 'row.save': '保存',
+                           'row.xml_render': 'XML渲染', 'row.write': '写入',
+                           'generate.load_template': '加载模板'}
+            stage_text = "，".join(f"{label} {stage_seconds[name]:.2f} 秒"
+                                   for name, label in stage_names.items() if name in stage_seconds)
+            written_mb = stats.get('output_bytes', stats['bytes_written']) / (1024 * 1024)
+            self.status.insert(tk.END, f"📊 {stage_text}，共写入 {written_mb:.1f} MB，平均每份 "
+                                       f"{stats['bytes_per_doc'] / 1024:.1f} KB（详见 .mailmerge_metrics.json）\n")
+        if cancelled:
+            self.status.insert(tk.END, f"⏹ 已取消，已生成 {successful_docs} 份文档，保存在：{output_path}\n")
+        else:
+            self.status.insert(tk.END, f"🎉 成功生成 {successful_docs} 份文档，保存在：{output_path}\n")
+        
+        if issues:
+            self.status.insert(tk.END, f"⚠️ 处理过程中有 {len(issues)} 个问题\n")
+            messagebox.showinfo("完成", f"成功生成 {successful_docs} 份文档，有 {len(issues)} 个问题。请查看日志了解详情。")
+        elif cancelled:
+            messagebox.showinfo("已取消", f"已取消，成功生成 {successful_docs} 份文档。")
+        else:
+            messagebox.showinfo("完成", f"成功生成 {successful_docs} 份文档！")
+
+# 单份文档的预览窗口
+class PreviewWindow:
+    """
+    用已加载的数据和缓存的模板渲染选中的一份文档（分组时为一组），显示替换后的正文、
+    表格和页眉页脚文字，未替换的占位符高亮显示。不写任何文件，可以逐份前后翻看
+    """
+    def __init__(self, app):
+        self.app = app
+        group_column = app.group_column.get() or None
+        self.groups = group_rows(app.formatted_data, group_column) if group_column else None
+        self.count = len(self.groups) if self.groups else len(app.formatted_data)
+        self.row_templates = app.resolve_row_templates() if app.template_column.get() else None
+        self.default_template = os.path.abspath(app.word_path) if app.word_path else None
+        self.position = 0
+
+        self.window = tk.Toplevel(app.root)
+        self.window.title("预览替换结果")
+        self.window.geometry("760x600")
+
+        # 翻页按钮和份数输入框
+        bar = tk.Frame(self.window)
+        bar.pack(fill=tk.X, pady=5)
+        tk.Button(bar, text="◀ 上一份", command=lambda: self.show(self.position - 1)).pack(side=tk.LEFT, padx=5)
+        self.position_entry = tk.Entry(bar, width=8)
+        self.position_entry.pack(side=tk.LEFT)
+        self.position_entry.bind("<Return>", lambda event: self.jump())
+        tk.Label(bar, text=f"/ {self.count} 份").pack(side=tk.LEFT)
+        tk.Button(bar, text="下一份 ▶", command=lambda: self.show(self.position + 1)).pack(side=tk.LEFT, padx=5)
+        tk.Button(bar, text="刷新", command=lambda: self.show(self.position)).pack(side=tk.LEFT)
+        self.info_label = tk.Label(self.window, text="", anchor="w")
+        self.info_label.pack(fill=tk.X, padx=5)
+
+        # 替换后的文字：位置为灰色，未替换的占位符高亮
+        frame = tk.Frame(self.window)
+        frame.pack(fill=tk.BOTH, expand=True)
+        scrollbar = tk.Scrollbar(frame)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.text = tk.Text(frame, wrap=tk.WORD, yscrollcommand=scrollbar.set)
+        self.text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=self.text.yview)
+        self.text.tag_config("label", foreground="gray")
+        self.text.tag_config("unreplaced", background="yellow", foreground="red")
+
+        # PageUp / PageDown 翻页
+        self.window.bind("<Prior>", lambda event: self.show(self.position - 1))
+        self.window.bind("<Next>", lambda event: self.show(self.position + 1))
+        self.show(0)
+
+    def jump(self):
+        try:
+            self.show(int(self.position_entry.get()) - 1)
+        except ValueError:
+            self.show(self.position)
+
+    def show(self, position):
+        self.position = max(0, min(position, self.count - 1))
+        self.position_entry.delete(0, tk.END)
+        self.position_entry.insert(0, str(self.position + 1))
+        row, row_data = document_row_data(self.app.formatted_data, self.groups, self.position)
+        template_path = self.row_templates[row] if self.row_templates is not None else self.default_template
+        
+        self.text.config(state=tk.NORMAL)
+        self.text.delete("1.0", tk.END)
+        started = time.perf_counter()
+        try:
+            if template_path is None:
+                raise ValueError("没有指定模板")
+            lines, replaced = render_preview(self.app.preview_templates.get(template_path), row_data)
+        except Exception as e:
+            self.text.insert(tk.END, f"❌ 第 {row + 1} 行无法预览：{e}\n")
+            self.text.config(state=tk.DISABLED)
+            self.info_label.config(text="")
+            return
+        elapsed = time.perf_counter() - started
+        
+        unreplaced = set()
+        for label, text in lines:
+            self.text.insert(tk.END, f"[{label}] ", "label")
+            pos = 0
+            for match in PLACEHOLDER_PATTERN.finditer(text):
+                unreplaced.add(match.group(1))
+                self.text.insert(tk.END, text[pos:match.start()])
+                self.text.insert(tk.END, match.group(0), "unreplaced")
+                pos = match.end()
+            self.text.insert(tk.END, text[pos:] + "\n")
+        self.text.config(state=tk.DISABLED)
+        
+        rows_text = f"第 {row + 1} 行所在分组（共 {len(row_data.records)} 行）" if self.groups else f"第 {row + 1} 行"
+        self.info_label.config(text=f"{rows_text}，模板 {os.path.basename(template_path)}，替换 {replaced} 处，"
+                                    f"未替换 {len(unreplaced)} 个占位符，耗时 {elapsed * 1000:.1f} 毫秒")
+
+# 常驻合并服务
+class MergeService:
+    """
+    任务进入队列，由 max_jobs 个线程依次执行；解析过的模板和最近读取的工作簿保存在
+    按修改时间失效的LRU缓存中，连续的小任务不再重复加载
+    """
+    # 保留的已结束任务数量
+    finished_jobs_kept = 200
+
+    def __init__(self, max_jobs=1, template_capacity=16, workbook_capacity=4):
+        self.templates = FileLRUCache(TemplatePool, template_capacity)
+        self.workbooks = FileLRUCache(lambda path: open_row_source(path).load(), workbook_capacity)
+        self.jobs = collections.OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(max_jobs)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, params):
+        """
+        params 至少包含 excel（数据文件）和 template（或 template_column），可选 query、format_rules、
+        name_column、output_dir、workers、xml_engine、incremental、output_mode、group_by、template_dir、
+        compression_level、store_media、prune。
+        返回任务状态
+        """
+        if not isinstance(params, dict) or not params.get('excel') or not (params.get('template') or params.get('template_column')):
+            raise ValueError("任务需要 excel 和 template（或 template_column）")
+        if params.get('output_mode', 'files') not in OUTPUT_MODES:
+            raise ValueError(f"未知的输出方式：{params['output_mode']}")
+        if params.get('template_column') and params.get('output_mode') == 'combined':
+            raise ValueError(COMBINED_TEMPLATE_COLUMN_ERROR)
+        with self._lock:
+            job_id = str(next(self._ids))
+            job = {'id': job_id, 'state': 'queued', 'params': params, 'done': 0, 'total': None,
+                   'submitted': datetime.datetime.now().isoformat(timespec='seconds')}
+            self.jobs[job_id] = job
+            self._prune()
+        self._queue.put(job)
+        return self.status(job_id)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['state'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - self.finished_jobs_kept)]:
+            del self.jobs[job_id]
+
+    def status(self, job_id=None):
+        with self._lock:
+            if job_id is None:
+                return [dict(job) for job in self.jobs.values()]
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def info(self):
+        return {'queued': self._queue.qsize(), 'workers': len(self._threads),
+                'templates': self.templates.info(), 'workbooks': self.workbooks.info()}
+
+    def _update(self, job, **values):
+        with self._lock:
+            job.update(values)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            self._execute(job)
+
+    def _execute(self, job):
+        params = job['params']
+        self._update(job, state='running')
+        started = time.perf_counter()
+        timings = {}
+        try:
+            stage_started = time.perf_counter()
+            if params.get('query') or params.get('format_rules'):
+                # 带查询语句或格式规则的数据源不缓存
+                source = open_row_source(params['excel'], params.get('query'), params.get('format_rules'))
+                columns, formatted_data = source.load()
+            else:
+                columns, formatted_data = self.workbooks.get(params['excel'])
+            timings['read_excel'] = time.perf_counter() - stage_started
+            name_column = params.get('name_column') or (columns[0] if columns else None)
+            for column in (name_column, params.get('group_by'), params.get('template_column')):
+                if column and column not in columns:
+                    raise ValueError(f"Excel 中没有列：{column}")
+            output_dir = params.get('output_dir') or os.path.join(
+                os.path.dirname(os.path.abspath(params['excel'])), "output_docs")
+            os.makedirs(output_dir, exist_ok=True)
+            output_names = [make_safe_filename(value, i) for i, value in enumerate(column_values(formatted_data, name_column))]
+            
+            stage_started = time.perf_counter()
+            pool = self.templates.get(params['template']) if params.get('template') else None
+            timings['load_template'] = time.perf_counter() - stage_started
+            stats = {}
+            with pool.checkout() if pool is not None else contextlib.nullcontext() as template:
+                successful_docs, issues = generate_documents(
+                    template.word_path if template is not None else None, formatted_data, output_names, output_dir,
+                    workers=int(params.get('workers', 1)), use_xml_engine=bool(params.get('xml_engine')),
+                    incremental=bool(params.get('incremental')), output_mode=params.get('output_mode', 'files'),
+                    group_column=params.get('group_by'), stats=stats, template=template,
+                    template_column=params.get('template_column'), template_dir=params.get('template_dir'),
+                    compression_level=params.get('compression_level'), store_media=bool(params.get('store_media')),
+                    prune_parts=bool(params.get('prune')),
+                    progress_callback=lambda done, total: self._update(job, done=done, total=total))
+            timings['render'] = stats['render']
+            timings['total'] = time.perf_counter() - started
+            self._update(job, state='done', output_path=stats['output_path'], successes=successful_docs,
+                         bytes_per_doc=stats['bytes_per_doc'],
+                         skipped=stats['skipped'], failures=len(issues), issues=issues,
+                         timings={stage: round(seconds, 4) for stage, seconds in timings.items()})
+        except Exception as e:
+            logger.error(f"任务 {job['id']} 执行失败: {e}")
+            self._update(job, state='failed', error=str(e))
+
+# 启动常驻服务（本机 HTTP）
+def run_service(host="127.0.0.1", port=8765, max_jobs=1):
+    """
+    POST /jobs 提交任务（JSON），GET /jobs/<id> 查询任务状态，GET /jobs 列出任务，
+    GET /health 查看队列和缓存状态
+    """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    # 预先导入，第一个任务不再等待
+    import docx
+    import openpyxl
+    
+    service = MergeService(max_jobs)
+    
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def do_GET(self):
+            if self.path == "/health":
+                self._reply(200, service.info())
+            elif self.path == "/jobs":
+                self._reply(200, service.status())
+            elif self.path.startswith("/jobs/"):
+                job = service.status(self.path[len("/jobs/"):])
+                if job is None:
+                    self._reply(404, {"error": "任务不存在"})
+                else:
+                    self._reply(200, job)
+            else:
+                self._reply(404, {"error": "未知路径"})
+        
+        def do_POST(self):
+            if self.path != "/jobs":
+                self._reply(404, {"error": "未知路径"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                job = service.submit(json.loads(self.rfile.read(length) or b"{}"))
+            except ValueError as e:
+                self._reply(400, {"error": str(e)})
+                return
+            self._reply(202, job)
+        
+        def log_message(self, format, *args):
+            logger.info(f"{self.address_string()} {format % args}")
+    
+    server = ThreadingHTTPServer((host, port), Handler)
+    logger.info(f"合并服务已启动：http://{host}:{port}（同时执行 {max_jobs} 个任务）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+# 命令行模式
+def run_cli(argv):
+    """
+    无界面执行合并，结束时向标准输出打印 JSON 统计信息；
+    全部成功返回 0，有行出错返回 1，无法执行返回 2
+    """
+    parser = argparse.ArgumentParser(description="Excel-Word 邮件合并工具（命令行模式）")
+    parser.add_argument("--serve", action="store_true", help="以常驻服务方式运行，通过本机 HTTP 接收合并任务")
+    parser.add_argument("--host", default="127.0.0.1", help="服务监听地址，默认只允许本机访问")
+    parser.add_argument("--port", type=int, default=8765, help="服务监听端口")
+    parser.add_argument("--max-jobs", type=int, default=1, help="服务同时执行的任务数")
+    parser.add_argument("--excel", "--source", dest="excel",
+                        help="数据文件：Excel（.xlsx）、CSV（.csv）或 SQLite 数据库（.db/.sqlite）")
+    parser.add_argument("--query", help="SQLite 数据源的查询语句，如 \"SELECT * FROM 询证函\"")
+    parser.add_argument("--format-rules", help="列格式规则 JSON 文件：{列名: Excel格式代码}，如 {\"编号\": \"000\"}")
+    parser.add_argument("--template", help="Word 模板文件（.docx）；给出 --template-column 时为该列为空的行使用的默认模板")
+    parser.add_argument("--template-column", help="模板列：每行按该列的值选择模板（模板路径或 --template-dir 中的文件名）")
+    parser.add_argument("--template-dir", help="模板列中文件名所在的文件夹，默认使用 --template 所在文件夹")
+    parser.add_argument("--template-pool-size", type=int, default=16, help="每个进程缓存的已解析模板数量")
+    parser.add_argument("--name-column", help="用于命名生成文档的列名，默认使用第一列")
+    parser.add_argument("--output-dir", help="输出文件夹，默认使用 Excel 同目录的 output_docs")
+    parser.add_argument("--workers", type=int, default=1, help="并行进程数")
+    parser.add_argument("--xml-engine", action="store_true", help="使用XML快速引擎")
+    parser.add_argument("--incremental", action="store_true", help="跳过内容未变化且文件已存在的行")
+    parser.add_argument("--shard", type=parse_shard,
+                        help="分片运行，如 2/4 表示共 4 个分片中的第 2 个；各分片可在共享同一输出目录的多台机器上同时运行")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="汇总输出目录中各分片的结果，检查缺失或重复的文档并合并清单")
+    parser.add_argument("--group-by", help="分组列：同组多行生成一份文档，模板表格中含 «@列名» 的行按组内每行重复")
+    parser.add_argument("--output-mode", choices=list(OUTPUT_MODES), default="files",
+                        help="files 每行一个文件，zip 打包为一个 zip 文件，combined 合并为一个 Word 文档")
+    parser.add_argument("--compression-level", type=int, choices=range(10), metavar="0-9",
+                        help="输出文档的压缩级别，0 不压缩，9 最小，默认与 Word 相同")
+    parser.add_argument("--store-media", action="store_true", help="图片等已压缩的媒体直接存储，不再压缩")
+    parser.add_argument("--prune", action="store_true", help="删除模板中未使用的样式、缩略图和构建基块")
+    parser.add_argument("--writer-threads", type=int, default=2,
+                        help="逐个文件输出时的后台写盘线程数，0 表示由生成进程直接写入")
+    parser.add_argument("--dry-run", action="store_true", help="只预检全部数据并输出 JSON 报告，不生成文档")
+    parser.add_argument("--preview", type=int, metavar="N",
+                        help="只预览第 N 份文档（分组时为第 N 组）替换后的文字并输出 JSON，不生成文档")
+    parser.add_argument("--metrics", help="运行结束后把详细指标写入该文件（.json 汇总或 .csv 每行明细）")
+    parser.add_argument("--profile-every", type=int, default=0,
+                        help="每隔 N 行用 cProfile 采样一次，结果写入与指标文件同名的 .prof 文件")
+    args = parser.parse_args(argv)
+    
+    if args.serve:
+        return run_service(args.host, args.port, args.max_jobs)
+    if args.merge_shards:
+        if not (args.output_dir or args.excel):
+            parser.error("--merge-shards 需要 --output-dir")
+        output_dir = args.output_dir or os.path.join(os.path.dirname(os.path.abspath(args.excel)), "output_docs")
+        try:
+            report = merge_shard_reports(output_dir)
+        except Exception as e:
+            logger.error(f"汇总分片结果时发生错误: {e}")
+            print(json.dumps({"output_dir": output_dir, "error": str(e)}, ensure_ascii=False))
+            return 2
+        print(json.dumps(report, ensure_ascii=False))
+        return 0 if report['complete'] else 1
+    if not (args.excel and (args.template or args.template_column)):
+        parser.error("需要 --excel（或 --source）和 --template（或 --template-column）")
+    if args.template_column and args.output_mode == 'combined':
+        parser.error(COMBINED_TEMPLATE_COLUMN_ERROR)
+    
+    stats = {"excel": args.excel, "template": args.template}
+    if args.template_column:
+        stats['template_column'] = args.template_column
+    timings = {}
+    run_stats = {}
+    profile_path = None
+    if args.profile_every:
+        profile_path = os.path.splitext(args.metrics or "mailmerge")[0] + ".prof"
+    metrics = MergeMetrics(profile_every=args.profile_every, profile_path=profile_path)
+    started = time.perf_counter()
+    try:
+        stage_started = time.perf_counter()
+        format_rules = load_format_rules(args.format_rules) if args.format_rules else None
+        columns, formatted_data = open_row_source(args.excel, args.query, format_rules).load(metrics)
+        timings['read_excel'] = time.perf_counter() - stage_started
+        
+        name_column = args.name_column or (columns[0] if columns else None)
+        if name_column not in columns:
+            raise ValueError(f"Excel 中没有列：{name_column}")
+        for column in (args.group_by, args.template_column):
+            if column and column not in columns:
+                raise ValueError(f"Excel 中没有列：{column}")
+        
+        output_dir = args.output_dir or os.path.join(os.path.dirname(os.path.abspath(args.excel)), "output_docs")
+        if args.dry_run:
+            row_templates = None
+            if args.template_column:
+                row_templates = resolve_row_templates(
+                    formatted_data, args.template_column,
+                    args.template_dir or (os.path.dirname(os.path.abspath(args.template)) if args.template else None),
+                    args.template)
+            placeholders = template_cache.placeholders(args.template) if args.template else set()
+            report = validate_rows(columns, formatted_data, placeholders, name_column, output_dir,
+                                   group_column=args.group_by, row_templates=row_templates)
+            for line in format_validation_report(report):
+                logger.info(line)
+            stats.update(dry_run=report)
+            print(json.dumps(stats, ensure_ascii=False))
+            return 1 if report['problems'] else 0
+        if args.preview is not None:
+            groups = group_rows(formatted_data, args.group_by) if args.group_by else None
+            count = len(groups) if groups else len(formatted_data)
+            if not 1 <= args.preview <= count:
+                raise ValueError(f"共 {count} 份文档，没有第 {args.preview} 份")
+            row, row_data = document_row_data(formatted_data, groups, args.preview - 1)
+            template_path = args.template
+            if args.template_column:
+                template_path = resolve_row_templates(
+                    [formatted_data[row]], args.template_column,
+                    args.template_dir or (os.path.dirname(os.path.abspath(args.template)) if args.template else None),
+                    args.template)[0]
+            if template_path is None:
+                raise ValueError(f"第 {row + 1} 行没有指定模板")
+            template = CompiledTemplate.load(template_path)
+            stage_started = time.perf_counter()
+            lines, replaced = render_preview(template, row_data)
+            timings['preview'] = time.perf_counter() - stage_started
+            unreplaced = sorted({field for _, text in lines for field in PLACEHOLDER_PATTERN.findall(text)})
+            stats.update(row=row + 1, preview_template=template_path, replaced=replaced, unreplaced=unreplaced,
+                         lines=lines, timings={stage: round(seconds, 4) for stage, seconds in timings.items()})
+            print(json.dumps(stats, ensure_ascii=False))
+            return 0
+        os.makedirs(output_dir, exist_ok=True)
+        output_names = [make_safe_filename(value, i) for i, value in enumerate(column_values(formatted_data, name_column))]
+        
+        successful_docs, issues = generate_documents(
+            args.template, formatted_data, output_names, output_dir,
+            workers=args.workers, use_xml_engine=args.xml_engine, stats=run_stats,
+            incremental=args.incremental, metrics=metrics, output_mode=args.output_mode,
+            writer_threads=args.writer_threads, group_column=args.group_by, shard=args.shard,
+            template_column=args.template_column, template_dir=args.template_dir,
+            template_pool_size=args.template_pool_size, compression_level=args.compression_level,
+            store_media=args.store_media, prune_parts=args.prune)
+    except Exception as e:
+        logger.error(f"生成文档过程中发生错误: {e}")
+        stats.update(error=str(e), timings={stage: round(seconds, 4) for stage, seconds in timings.items()})
+        print(json.dumps(stats, ensure_ascii=False))
+        return 2
+    
+    skipped = run_stats.pop('skipped')
+    run_stats.pop('cancelled')
+    output_path = run_stats.pop('output_path')
+    groups = run_stats.pop('groups', None)
+    bytes_written = run_stats.pop('bytes_written')
+    bytes_per_doc = run_stats.pop('bytes_per_doc')
+    output_bytes = run_stats.pop('output_bytes', None)
+    timings.update(run_stats)
+    timings['total'] = time.perf_counter() - started
+    if args.metrics:
+        metrics.add_stage('total', timings['total'])
+        metrics.export(args.metrics)
+    stats.update(
+        output_dir=output_dir,
+        output_path=output_path,
+        shard=f"{args.shard[0]}/{args.shard[1]}" if args.shard else None,
+        rows=len(formatted_data),
+        groups=groups,
+        successes=successful_docs,
+        skipped=skipped,
+        failures=len(issues),
+        bytes_written=bytes_written,
+        bytes_per_doc=bytes_per_doc,
+        output_bytes=output_bytes,
+        replaced=metrics.counters.get('replaced_total', 0),
+        issues=issues,
+        timings={stage: round(seconds, 4) for stage, seconds in timings.items()},
+    )
+    print(json.dumps(stats, ensure_ascii=False))
+    return 1 if issues else 0
+
+# 启动图形界面
+def run_gui():
+    global tk, filedialog, messagebox, simpledialog, ttk
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, simpledialog
+    from tkinter import ttk
+    
     root = tk.Tk()
     app = MailMergeApp(root)
     root.mainloop()
+
+
+# 有命令行参数时以无界面模式运行，否则启动界面
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        sys.exit(run_cli(sys.argv[1:]))
+    run_gui()